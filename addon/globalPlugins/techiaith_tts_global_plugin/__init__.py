@@ -28,6 +28,7 @@ from techiaith_tts.tts_system import (
     TechiaithTextToSpeechSystem,
     TECHIAITH_VOICES_DIR,
 )
+from techiaith_tts.voice_index import try_update_voice_index
 sys.path.remove(_TTS_MODULE_DIR)
 del _DIR, _ADDON_ROOT, _TTS_MODULE_DIR
 
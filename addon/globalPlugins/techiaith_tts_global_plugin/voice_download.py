@@ -21,7 +21,7 @@ import core
 import gui
 from logHandler import log
 
-from . import TechiaithTextToSpeechSystem, helpers, TECHIAITH_VOICES_DIR
+from . import TechiaithTextToSpeechSystem, helpers, try_update_voice_index, TECHIAITH_VOICES_DIR
 
 with helpers.import_bundled_library():
     import mureq as request
@@ -152,6 +152,7 @@ class PiperVoiceDownloader:
                     except IOError:
                         log.exception("Failed to copy file: {file}", exc_info=True)
                         has_error = True
+                try_update_voice_index()
 
         self.progress_dialog.Hide()
         self.progress_dialog.Destroy()
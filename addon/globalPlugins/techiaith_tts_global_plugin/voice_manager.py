@@ -20,7 +20,7 @@ import gui
 import synthDriverHandler
 from logHandler import log
 
-from . import TechiaithTextToSpeechSystem, TECHIAITH_VOICES_DIR
+from . import TechiaithTextToSpeechSystem, try_update_voice_index, TECHIAITH_VOICES_DIR
 from . import voice_download
 from . import aio
 from . import helpers
@@ -172,6 +172,7 @@ class InstalledTechiaithVoicesPanel(SizedPanel):
                     style=wx.ICON_WARNING
                 )
             else:
+                try_update_voice_index()
                 gui.messageBox(
                     # Translators: message in a message box
                     _("Voice removed successfully."),
@@ -216,6 +217,7 @@ class InstalledTechiaithVoicesPanel(SizedPanel):
                 style=wx.ICON_ERROR,
             )
         else:
+            try_update_voice_index()
             gui.messageBox(
                 # Translators: message telling the user that installing the voice is successful
                 _(
@@ -466,4 +468,3 @@ def play_remote_mp3(mp3_url):
             wav_file,
             winsound.SND_FILENAME | winsound.SND_PURGE
         )
-
@@ -3,9 +3,11 @@
 # Copyright (c) 2023 Musharraf Omer
 # This file is covered by the GNU General Public License.
 
-from asyncio.exceptions import CancelledError
+import time
 from collections import OrderedDict
-from contextlib import suppress
+from contextlib import aclosing, suppress
+from enum import Enum
+from functools import partial
 
 import config
 import languageHandler
@@ -32,12 +34,22 @@ from synthDriverHandler import (
 from . import grpc_client
 from . import aio
 from ._config import TechiaithConfig
+from .const import (
+    ADAPTIVE_UNDERRUN_TOLERANCE,
+    LOOKAHEAD_MAX_CHUNKS,
+    SYNTHESIS_MODE_AUTO,
+    SYNTHESIS_MODES,
+)
 from .helpers import update_displaied_params_on_voice_change
+from .instrumentation import METRICS
+from .audio_cache import AudioCache
+from .audio_feeder import AudioFeeder
+from .speech_queue import SpeechQueue
+from .variant_selector import VARIANT_SELECTOR
+from .voice_residency import VOICE_RESIDENCY
 from .aio import (
     ASYNCIO_EVENT_LOOP,
-    CancelledError,
     asyncio,
-    asyncio_cancel_task,
     asyncio_coroutine_to_concurrent_future,
     run_in_executor,
 )
@@ -56,64 +68,176 @@ aio.initialize()
 _GRPC_IS_INIT = grpc_client.initialize()
 
 
+class StartupState(Enum):
+    # Connecting to the server and loading the configured voice
+    STARTING = "starting"
+    READY = "ready"
+    FAILED = "failed"
+
+
 class DoneSpeakingTask:
-    __slots__ = ["player", "on_index_reached",]
+    """Reports done speaking when the audio queued before it has played."""
+
+    __slots__ = ["feeder", "on_index_reached",]
 
-    def __init__(self, player, onIndexReached):
-        self.player = player
+    def __init__(self, feeder, onIndexReached):
+        self.feeder = feeder
         self.on_index_reached = onIndexReached
 
     async def __call__(self):
-        await run_in_executor(self.player.idle)
-        await run_in_executor(self.on_index_reached, None)
+        self.feeder.add_marker(partial(self._on_played, sayAll.SayAllHandler.isRunning()))
+
+    def _on_played(self, say_all_running):
+        if not say_all_running:
+            # The audio has drained, so this does not wait for playback
+            self.feeder.request_idle()
+        self.on_index_reached(None)
 
 
 class IndexReachedTask:
-    __slots__ = ["callback", "index_list"]
+    """Reports an index when the audio queued before it has played."""
+
+    __slots__ = ["feeder", "callback", "index"]
 
-    def __init__(self, callback, index_list):
+    def __init__(self, feeder, callback, index):
+        self.feeder = feeder
         self.callback = callback
-        self.index_list = index_list
+        self.index = index
 
     async def __call__(self):
-        for index in self.index_list:
-            await run_in_executor(self.callback, index)
+        self.feeder.add_marker(partial(self.callback, self.index))
 
 
 class SpeechTask:
     __slots__ = [
         "task",
-        "player",
+        "feeder",
+        "audio_cache",
+        "_prerender_queue",
+        "_prerender_task",
+        "continues_playback",
     ]
 
-    def __init__(self, task, player):
+    def __init__(self, task, feeder, audio_cache=None):
         self.task = task
-        self.player = player
+        self.feeder = feeder
+        self.audio_cache = audio_cache
+        self._prerender_queue = None
+        self._prerender_task = None
+        # Whether this speech was queued to play straight after the previous speech
+        self.continues_playback = False
 
     async def __call__(self):
+        # Time to first audio is only measured for speech that starts from
+        # silence, speech queued behind playing audio would only measure the
+        # queue. A gap before such speech is recorded as an underrun instead
+        start_time = None if self.feeder.is_playing() else time.perf_counter()
+        if self._prerender_task is not None:
+            audio_stream = self._iter_prerendered_audio()
+        else:
+            audio_stream = self._iter_audio()
+        feed_func = self.feeder.feed
+        bytes_fed = 0
+        try:
+            async with aclosing(audio_stream):
+                async for wave_samples in audio_stream:
+                    if bytes_fed or self.continues_playback:
+                        self._check_underrun()
+                    await feed_func(wave_samples)
+                    if (not bytes_fed) and (start_time is not None):
+                        self.feeder.add_fed_callback(
+                            partial(METRICS.record_elapsed, "time_to_first_audio", start_time)
+                        )
+                    bytes_fed += len(wave_samples)
+            METRICS.record("bytes_per_utterance", bytes_fed)
+        finally:
+            await self.cancel_prerender()
+
+    def _check_underrun(self):
+        """Record if the player ran out of audio while waiting for this chunk."""
+        starved_seconds = self.feeder.get_starved_seconds()
+        if starved_seconds > ADAPTIVE_UNDERRUN_TOLERANCE:
+            METRICS.record("underrun", starved_seconds * 1000)
+            VARIANT_SELECTOR.record_underrun()
+
+    def prerender(self):
+        """Start synthesizing speculatively, while previous speech is still playing.
+        At most `LOOKAHEAD_MAX_CHUNKS` chunks of audio are buffered.
+        """
+        if self._prerender_task is not None:
+            return
+        self._prerender_queue = asyncio.Queue(maxsize=LOOKAHEAD_MAX_CHUNKS)
+        self._prerender_task = ASYNCIO_EVENT_LOOP.create_task(self._prerender_audio())
+
+    async def cancel_prerender(self):
+        """Cancel speculative synthesis and wait until it has stopped."""
+        task = self._prerender_task
+        if (task is not None) and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _prerender_audio(self):
+        queue = self._prerender_queue
+        audio_stream = self._iter_audio()
+        try:
+            async with aclosing(audio_stream):
+                async for wave_samples in audio_stream:
+                    await queue.put(wave_samples)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(None)
+
+    async def _iter_prerendered_audio(self):
+        while True:
+            wave_samples = await self._prerender_queue.get()
+            if wave_samples is None:
+                return
+            elif isinstance(wave_samples, Exception):
+                raise wave_samples
+            yield wave_samples
+
+    async def _iter_audio(self):
+        self.task.select_variant()
+        cache_key = self.task.cache_key if self.audio_cache is not None else None
         if sayAll.SayAllHandler.isRunning():
             self.task.text = self.task.text.replace("\n", " ")
             self.task.speech_options.sentence_silence_ms = 50
+            self.task.speech_options.is_say_all = True
+            cache_key = None
+        if cache_key is not None:
+            cached_pcm = self.audio_cache.get_from_memory(cache_key)
+            if cached_pcm is None:
+                cached_pcm = await run_in_executor(self.audio_cache.get_from_disk, cache_key)
+            elif self.audio_cache.is_due_for_disk(cache_key):
+                # Fire and forget, the disk write should not delay playback
+                run_in_executor(self.audio_cache.write_to_disk, cache_key)
+            if cached_pcm is not None:
+                yield cached_pcm
+                return
         speech_stream = await self.task.generate_audio()
-        feed_func = self.player.feed
-        async for wave_samples in speech_stream:
-            await run_in_executor(feed_func, wave_samples)
-        self.player.sync()
+        synthesized = []
+        async with aclosing(speech_stream):
+            async for wave_samples in speech_stream:
+                yield wave_samples
+                if cache_key is not None:
+                    synthesized.append(wave_samples)
+        if synthesized:
+            self.audio_cache.put(cache_key, b"".join(synthesized))
 
 
 class BreakTask:
     __slots__ = [
         "task",
-        "player",
+        "feeder",
     ]
 
-    def __init__(self, task, player):
+    def __init__(self, task, feeder):
         self.task = task
-        self.player = player
+        self.feeder = feeder
 
     async def __call__(self):
-        await run_in_executor(self.player.feed, self.task.generate_audio())
-        await run_in_executor(self.player.sync)
+        await self.feeder.feed(self.task.generate_audio())
 
 
 def SpeakerSetting():
@@ -127,6 +251,18 @@ def SpeakerSetting():
         displayName=_("Speaker"),
     )
 
+def SynthesisModeSetting():
+    """Factory function for creating synthesis mode setting."""
+    return DriverSetting(
+        "synthesis_mode",
+        # Translators: Label for a setting in voice settings dialog.
+        _("S&ynthesis mode"),
+        availableInSettingsRing=False,
+        # Translators: Label for a setting in synth settings ring.
+        displayName=_("Synthesis mode"),
+    )
+
+
 def create_wave_player(sample_rate):
     return WavePlayer(
         channels=1,
@@ -136,23 +272,51 @@ def create_wave_player(sample_rate):
     )
 
 
-async def _process_speech_sequence(speech_seq):
-    for callable in speech_seq:
-        try:
-            await callable()
-        except Exception as e:
-            if isinstance(e, CancelledError):
-                log.debug("Canceld speech task {callable}", exc_info=True)
-            else:
+async def _process_speech_sequence(speech_seq, previous_task, may_synthesize, synthesized):
+    """Speak `speech_seq` after `previous_task`, if any. It is synthesized
+    ahead once `may_synthesize`, if any, is set. `synthesized` is set
+    once its synthesis has finished. If speaking fails, the rest of the
+    audio is skipped, but indexes and done speaking are still reported,
+    so that NVDA does not wait for them forever.
+    """
+    speech_tasks = [c for c in speech_seq if isinstance(c, SpeechTask)]
+    if not speech_tasks:
+        synthesized.set()
+    try:
+        if previous_task is not None:
+            # Lookahead: synthesize while the previous sequence is still
+            # playing, without competing with the speech ahead of this one
+            if may_synthesize is not None:
+                await may_synthesize.wait()
+            for speech_task in speech_tasks:
+                speech_task.prerender()
+            await asyncio.wait((previous_task,))
+        # Any gap from now on is an underrun, unless the previous speech
+        # had already finished playing
+        for speech_task in speech_tasks:
+            speech_task.continues_playback = speech_task.feeder.is_playing()
+        failed = False
+        for callable in speech_seq:
+            if failed and isinstance(callable, (SpeechTask, BreakTask)):
+                continue
+            try:
+                await callable()
+                if speech_tasks and (callable is speech_tasks[-1]):
+                    synthesized.set()
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    log.debug(f"Canceld speech task {callable}", exc_info=True)
+                    raise
+                # A server stream was cancelled, such as by a server restart
+                log.exception(f"Speech task {callable} was cancelled", exc_info=True)
+                failed = True
+            except Exception:
                 log.exception(f"Failed to execute speech task {callable}", exc_info=True)
-            break
-
-
-@asyncio_coroutine_to_concurrent_future
-async def process_speech(speech_seq):
-    speech_task = _process_speech_sequence(speech_seq)
-    return ASYNCIO_EVENT_LOOP.create_task(speech_task)
-
+                failed = True
+    finally:
+        synthesized.set()
+        for speech_task in speech_tasks:
+            await speech_task.cancel_prerender()
 
 
 class SynthDriver(synthDriverHandler.SynthDriver):
@@ -168,6 +332,7 @@ class SynthDriver(synthDriverHandler.SynthDriver):
         NumericDriverSetting("noise_scale", _("&Noise scale"), False),
         NumericDriverSetting("length_scale", _("&Length scale"), True),
         NumericDriverSetting("noise_w", _("Noise &w"), False),
+        SynthesisModeSetting(),
     )
     supportedCommands = {
         IndexCommand,
@@ -189,34 +354,23 @@ class SynthDriver(synthDriverHandler.SynthDriver):
 
     def __init__(self):
         super().__init__()
-        try:
-            _GRPC_IS_INIT.result()
-        except:
-            log.exception(
-                f"Failed to initialize Techiaith TTS services. Synthesizer will not be available.",
-                exc_info=True,
-            )
-            return
-        try:
-            techiaith_grpc_server_version = grpc_client.check_grpc_server().result()
-        except:
-            log.exception(
-                f"Failed to connect to Techiaith TTS GRPC server. Synthesizer will not be available.",
-                exc_info=True,
-            )
-            return
-        log.info(f"Techiaith TTS GRPC server running on port {grpc_client.SONATA_GRPC_SERVER_PORT}")
-        log.info("Connected to Techiaith TTS GRPC server")
-        log.info(f"Techiaith TTS GRPC server version: {techiaith_grpc_server_version}")
+        self._startup_state = StartupState.STARTING
+        self._speech_queue = SpeechQueue(
+            ASYNCIO_EVENT_LOOP, _process_speech_sequence, self._on_speech_cancelled
+        )
+        self._rateBoost = False
+        self.tts = None
+        self._players = {}
+        self._feeders = {}
+        self._feeder = None
         # Load Welsh voices only (filtered in load_voices_from_directory)
-        if not any(TechiaithTextToSpeechSystem.load_piper_voices_from_nvda_config_dir()):
+        self.voices = TechiaithTextToSpeechSystem.load_piper_voices_from_nvda_config_dir()
+        if not any(self.voices):
             log.error(
                 "No installed Welsh voices were found for Techiaith TTS. Synthesizer will not be available."
             )
+            self._startup_state = StartupState.FAILED
             return
-        self._current_task = None
-        self._rateBoost = False
-        self.voices = TechiaithTextToSpeechSystem.load_piper_voices_from_nvda_config_dir()
         try:
             voice_key = config.conf["speech"]["techiaith_tts"]["voice"]
             configured_voice = next(
@@ -224,116 +378,128 @@ class SynthDriver(synthDriverHandler.SynthDriver):
             )
         except (KeyError, StopIteration):
             configured_voice = self.voices[0]
+        # Only reads the voice config, the voice is loaded in the background
         init_speech_options = SpeechOptions(voice=configured_voice)
         self.tts = TechiaithTextToSpeechSystem(
             self.voices, speech_options=init_speech_options
         )
-        self._players = {}
-        self._player = self._get_or_create_player(
+        self._audio_cache = AudioCache()
+        aio.call_threaded(self._audio_cache.prune_disk)()
+        self._feeder = self._get_or_create_feeder(
             self.tts.speech_options.voice.sample_rate
         )
+        self._player = self._feeder.player
         self.availableLanguages = {v.language for v in self.voices}
         self._voice_map = {v.key: v for v in self.voices}
         self._standard_voice_map = {v.standard_variant_key: v for v in self.voices}
         self.availableVoices = self._get_valid_voices()
         self.__voice = self._get_variant_independent_voice_id(configured_voice.key)
+        grpc_client.add_restart_callback(self._on_server_restarted)
+        # Speech sent before startup completes waits for the voice to load
+        self._start_up(configured_voice).add_done_callback(self._on_startup_done)
+
+    @asyncio_coroutine_to_concurrent_future
+    async def _start_up(self, voice):
+        """Connect to the server and load the configured voice,
+        without blocking NVDA's main thread.
+        """
+        await asyncio.wrap_future(_GRPC_IS_INIT)
+        techiaith_grpc_server_version = await grpc_client.wait_until_ready()
+        log.info(f"Techiaith TTS GRPC server running on {grpc_client.get_server_address()}")
+        log.info("Connected to Techiaith TTS GRPC server")
+        log.info(f"Techiaith TTS GRPC server version: {techiaith_grpc_server_version}")
+        grpc_client.start_supervisor()
+        self._preload_variants(voice)
+        await voice.ensure_loaded()
+
+    def _preload_variants(self, voice):
+        """Load the other variant of `voice` in the background, alongside
+        `voice` itself, so that switching variant is instant.
+        Must be called from the event loop.
+        """
+        for variant_key in TechiaithTextToSpeechSystem.get_voice_variants(voice.key):
+            variant_voice = self._voice_map.get(variant_key)
+            if (variant_voice is None) or (variant_voice is voice):
+                continue
+            variant_voice.read_config()
+            if VOICE_RESIDENCY.has_room_for(variant_voice):
+                variant_voice.load_in_background()
+
+    async def _on_server_restarted(self):
+        await self.tts.reload_voices()
+
+    def _on_startup_done(self, future):
+        try:
+            future.result()
+        except:
+            self._startup_state = StartupState.FAILED
+            log.exception(
+                "Failed to start Techiaith TTS services. Synthesizer will not be available.",
+                exc_info=True,
+            )
+        else:
+            self._startup_state = StartupState.READY
+
+    def _get_startup_state(self):
+        return self._startup_state
 
     def terminate(self):
+        grpc_client.remove_restart_callback(self._on_server_restarted)
         self.cancel()
-        self.tts.shutdown()
+        if self.tts is not None:
+            self.tts.shutdown()
+        for feeder in self._feeders.values():
+            feeder.close()
+        self._feeders.clear()
         for player in self._players.values():
             player.close()
         self._players.clear()
 
     def speak(self, speechSequence):
+        if self._startup_state is StartupState.FAILED:
+            self._skip_speech(speechSequence)
+            return
         with self.tts.create_synthesis_context():
             self._fast_prepare_and_run_speech_task(speechSequence)
 
-    def _prepare_and_run_speech_task(self, speechSequence):
-        self.cancel()
-        speech_seq = []
-        text_list = []
-        index_command_list = []
-        default_lang = self.tts.language
+    def _skip_speech(self, speechSequence):
+        """Report the speech as spoken when the synthesizer is not
+        available, so that NVDA does not wait for its indexes forever.
+        """
         for item in speechSequence:
-            item_type = type(item)
-            if item_type is IndexCommand:
-                index_command_list.append(item.index)
-                continue
-            elif item_type is str:
-                text_list.append(item)
-                continue
-            if any(text_list):
-                speech_seq.append(
-                    SpeechTask(
-                        self.tts.create_speech_provider("".join(text_list)),
-                        self._player,
-                    )
-                )
-                text_list.clear()
-            if item_type is BreakCommand:
-                speech_seq.append(
-                    BreakTask(
-                        self.tts.create_break_provider(item.time),
-                        self._player,
-                    )
-                )
-            elif item_type is LangChangeCommand:
-                if item.isDefault:
-                    self.tts.language = default_lang
-                else:
-                    self.tts.language = item.lang
-            elif item_type is RateCommand:
-                self.tts.rate = item.newValue
-            elif item_type is VolumeCommand:
-                self.tts.volume = item.newValue
-            elif item_type is PitchCommand:
-                self.tts.pitch = item.newValue
-        if any(text_list):
-            speech_seq.append(
-                SpeechTask(
-                    self.tts.create_speech_provider("".join(text_list)),
-                    self._player,
-                )
-            )
-        if any(index_command_list):
-            speech_seq.append(IndexReachedTask(self._on_index_reached, index_command_list))
-        speech_seq.append(
-            DoneSpeakingTask(
-                self._player, self._on_index_reached
-            )
-        )
-        self._current_task = process_speech(
-            speech_seq
-        ).result()
+            if type(item) is IndexCommand:
+                self._on_index_reached(item.index)
+        self._on_index_reached(None)
 
     def _fast_prepare_and_run_speech_task(self, speechSequence):
-        self.cancel()
+        # NVDA cancels speech before it interrupts it, so speech is appended
+        # and synthesized while the speech before it is still playing
         speech_seq = []
         text_list = []
-        index_command_list = []
         default_lang = self.tts.language
         for item in speechSequence:
             item_type = type(item)
-            if item_type is IndexCommand:
-                index_command_list.append(item.index)
-                continue
-            elif item_type is str:
+            if item_type is str:
                 text_list.append(item)
                 continue
             if any(text_list):
                 speech_seq.append(
                     SpeechTask(
                         self.tts.create_speech_provider("\n".join(text_list)),
-                        self._player,
+                        self._feeder,
+                        self._audio_cache,
                     )
                 )
                 text_list.clear()
-            if item_type is BreakCommand:
+            if item_type is IndexCommand:
+                speech_seq.append(
+                    IndexReachedTask(self._feeder, self._on_index_reached, item.index)
+                )
+            elif item_type is BreakCommand:
                 speech_seq.append(
                     BreakTask(
                         self.tts.create_break_provider(item.time),
-                        self._player,
+                        self._feeder,
                     )
                 )
             elif item_type is LangChangeCommand:
@@ -351,24 +517,34 @@ class SynthDriver(synthDriverHandler.SynthDriver):
             speech_seq.append(
                 SpeechTask(
                     self.tts.create_speech_provider("\n".join(text_list)),
-                    self._player,
+                    self._feeder,
+                    self._audio_cache,
                 )
             )
-        if any(index_command_list):
-            speech_seq.append(IndexReachedTask(self._on_index_reached, index_command_list))
         speech_seq.append(
             DoneSpeakingTask(
-                self._player, self._on_index_reached
+                self._feeder, self._on_index_reached
             )
         )
-        self._current_task = process_speech(
-            speech_seq
-        ).result()
+        self._speech_queue.submit(speech_seq)
+
+    def get_speech_metrics(self):
+        """Return rolling latency statistics: time to first byte and audio,
+        server real-time factor, queue depth, bytes synthesized and cancellations.
+        """
+        return METRICS.summary()
 
     def cancel(self):
-        if self._current_task is not None:
-            asyncio_cancel_task(self._current_task)
-        self._player.stop()
+        self._speech_queue.cancel()
+        if self._feeder is not None:
+            # Silence the player now, rather than when the event loop gets to it
+            self._feeder.stop()
+
+    def _on_speech_cancelled(self):
+        # Cancelled speech may have fed audio since `cancel` was called,
+        # which the player may already be playing
+        if self._feeder is not None:
+            self._feeder.stop()
 
     def pause(self, switch):
         self._player.pause(switch)
@@ -400,6 +576,16 @@ class SynthDriver(synthDriverHandler.SynthDriver):
             self._players[sample_rate] = create_wave_player(sample_rate)
         return self._players[sample_rate]
 
+    def _get_or_create_feeder(self, sample_rate):
+        if sample_rate not in self._feeders:
+            self._feeders[sample_rate] = AudioFeeder(
+                self._get_or_create_player(sample_rate),
+                ASYNCIO_EVENT_LOOP,
+                name=f"audio_feeder_{sample_rate}",
+                bytes_per_second=sample_rate * 2,
+            )
+        return self._feeders[sample_rate]
+
     def _get_rateBoost(self):
         return self._rateBoost
 
@@ -527,13 +713,17 @@ class SynthDriver(synthDriverHandler.SynthDriver):
             speaker = None
         self._set_variant(variant)
 
-        # Reset params
-        self.noise_scale = self.noise_scale
-        self.length_scale = self.length_scale
-        self.noise_w = self.noise_w
+        # Reset params, sent to the server in a single request
+        with self.tts.speech_options.voice.coalesce_synth_options():
+            self.noise_scale = self.noise_scale
+            self.length_scale = self.length_scale
+            self.noise_w = self.noise_w
 
-        if speaker is not None:
-            self._set_speaker(speaker)
+            if speaker is not None:
+                self._set_speaker(speaker)
+        ASYNCIO_EVENT_LOOP.call_soon_threadsafe(
+            self._preload_variants, self.tts.speech_options.voice
+        )
         # Update gui if shown
         try:
             update_displaied_params_on_voice_change(self)
@@ -547,13 +737,15 @@ class SynthDriver(synthDriverHandler.SynthDriver):
         self.tts.language = value
 
     def _get_variant(self):
+        if self.tts.adaptive_variant:
+            return "adaptive"
         return self.tts.speech_options.voice.variant
 
     def _set_variant(self, value):
         if value is None:
             return
         variant = value.lower()
-        if variant == "standard":
+        if variant in ("standard", "adaptive"):
             voice_key = self.tts.speech_options.voice.standard_variant_key
         elif variant == "fast":
             voice_key = self.tts.speech_options.voice.fast_variant_key
@@ -563,11 +755,13 @@ class SynthDriver(synthDriverHandler.SynthDriver):
         if voice_key not in self._voice_map:
             return
         prev_speaker = self.tts.speech_options.voice.speaker
+        self.tts.adaptive_variant = variant == "adaptive"
         self.tts.voice = voice_key
         self.tts.speech_options.voice.speaker = prev_speaker
         TechiaithConfig.setdefault(self.voice, {})["variant"] = value
         voice = self.tts.speech_options.voice
-        self._player = self._get_or_create_player(voice.sample_rate)
+        self._feeder = self._get_or_create_feeder(voice.sample_rate)
+        self._player = self._feeder.player
 
     def _getAvailableVariants(self):
         std_key, rt_key = TechiaithTextToSpeechSystem.get_voice_variants(self.__voice)
@@ -576,6 +770,8 @@ class SynthDriver(synthDriverHandler.SynthDriver):
             rv["standard"] = VoiceInfo("standard", "Standard", self.language)
         if rt_key in self._voice_map:
             rv["fast"] = VoiceInfo("fast", "Fast", self.language)
+        if len(rv) == 2:
+            rv["adaptive"] = VoiceInfo("adaptive", "Adaptive", self.language)
         return rv
 
     def _get_variant_independent_voice_id(self, voice_key):
@@ -608,6 +804,28 @@ class SynthDriver(synthDriverHandler.SynthDriver):
         except SpeakerNotFoundError:
             TechiaithConfig.setdefault(self.voice, {})["speaker"] = self.tts.speaker
 
+    def _get_synthesis_mode(self):
+        return self.tts.synthesis_mode
+
+    def _set_synthesis_mode(self, value):
+        if (value != SYNTHESIS_MODE_AUTO) and (value not in SYNTHESIS_MODES):
+            value = SYNTHESIS_MODE_AUTO
+        self.tts.synthesis_mode = value
+
+    def _get_availableSynthesis_modes(self):
+        return OrderedDict(
+            (
+                # Translators: a synthesis mode in the voice settings dialog
+                (SYNTHESIS_MODE_AUTO, VoiceInfo(SYNTHESIS_MODE_AUTO, _("Automatic"))),
+                # Translators: a synthesis mode in the voice settings dialog
+                ("lazy", VoiceInfo("lazy", _("Lazy (fastest response)"))),
+                # Translators: a synthesis mode in the voice settings dialog
+                ("parallel", VoiceInfo("parallel", _("Parallel"))),
+                # Translators: a synthesis mode in the voice settings dialog
+                ("batched", VoiceInfo("batched", _("Batched (highest throughput)"))),
+            )
+        )
+
     def _get_availableSpeakers(self):
         return {spk: VoiceInfo(spk, spk, None) for spk in self.tts.get_speakers()}
 
@@ -7,7 +7,12 @@ import config
 from io import StringIO
 from configobj import ConfigObj
 
-_configSpec = """[voices]
+_configSpec = """warm_up_voices = boolean(default=True)
+transport = option("tcp", "unix", default="tcp")
+channel_profile = option("low_latency", "default", default="low_latency")
+max_loaded_voices = integer(default=0, min=0)
+loaded_voices_memory_budget = integer(default=0, min=0)
+[voices]
 [[__many__]]
 variant = string(default=None)
 speaker = string(default=None)
@@ -39,6 +44,12 @@ class TechiaithConfigManager:
     def __setitem__(self, key, value):
         config.conf["speech"]["techiaith_tts"][key] = value
 
+    def get(self, key, default=None):
+        try:
+            return config.conf["speech"]["techiaith_tts"][key]
+        except KeyError:
+            return default
+
     def setdefault(self, key, value):
         if key not in config.conf["speech"]["techiaith_tts"]:
             config.conf["speech"]["techiaith_tts"][key] = value
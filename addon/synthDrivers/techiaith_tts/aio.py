@@ -20,7 +20,7 @@ def initialize():
     global THREADED_EXECUTOR, ASYNCIO_EVENT_LOOP, ASYNCIO_LOOP_THREAD
 
     THREADED_EXECUTOR = ThreadPoolExecutor(
-        max_workers=os.cpu_count() // 2, thread_name_prefix="piper4nvda_executor"
+        max_workers=max(os.cpu_count() // 2, 1), thread_name_prefix="piper4nvda_executor"
     )
 
     if ASYNCIO_LOOP_THREAD:
@@ -0,0 +1,231 @@
+# coding: utf-8
+
+# Copyright (c) 2023 Musharraf Omer
+# This file is covered by the GNU General Public License.
+
+"""A two-tier cache for synthesized audio.
+
+The first tier is an in-memory LRU bounded by a byte budget.
+The second tier is an on-disk store of raw PCM files, which are read
+back whole in a single read. Only entries that recur are written to
+disk, once they have been hit in memory `AUDIO_CACHE_DISK_MIN_HITS` times.
+"""
+
+import contextlib
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from logHandler import log
+
+from .const import (
+    AUDIO_CACHE_DIR,
+    AUDIO_CACHE_MEMORY_BUDGET,
+    AUDIO_CACHE_DISK_BUDGET,
+    AUDIO_CACHE_DISK_MIN_HITS,
+    AUDIO_CACHE_DISK_PRUNE_RATIO,
+    AUDIO_CACHE_MAX_TEXT_CHARS,
+)
+
+
+# Bump this to invalidate entries written by older versions
+AUDIO_CACHE_FORMAT_VERSION = 2
+PCM_FILE_SUFFIX = ".pcm"
+
+
+def make_cache_key(voice, speech_options, text):
+    """Build a cache key covering everything that affects the audio,
+    including the voice's model files, so that audio from a voice that
+    has since been reinstalled or updated is not reused.
+    Returns None if the text should not be cached, or if the voice's
+    files could not be read.
+    """
+    if (len(text) > AUDIO_CACHE_MAX_TEXT_CHARS) or (voice.model_identity is None):
+        return None
+    synth_options = voice.synth_options
+    key = (
+        AUDIO_CACHE_FORMAT_VERSION,
+        voice.key,
+        voice.model_identity,
+        synth_options.speaker,
+        round(synth_options.length_scale, 3),
+        round(synth_options.noise_scale, 3),
+        round(synth_options.noise_w, 3),
+        speech_options.rate,
+        speech_options.pitch,
+        speech_options.volume,
+        speech_options.sentence_silence_ms,
+        text,
+    )
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+
+class AudioCache:
+    """Memory and disk cache of synthesized PCM keyed by `make_cache_key`."""
+
+    def __init__(
+        self,
+        cache_dir=AUDIO_CACHE_DIR,
+        memory_budget=AUDIO_CACHE_MEMORY_BUDGET,
+        disk_budget=AUDIO_CACHE_DISK_BUDGET,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        # Key -> `[pcm, hits, on_disk]`
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        # Size of the disk tier, measured by `prune_disk`
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self._prune_lock = threading.Lock()
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            log.exception("Failed to create audio cache directory", exc_info=True)
+            self.disk_budget = 0
+
+    def get_from_memory(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            self._memory.move_to_end(key)
+            entry[1] += 1
+            return entry[0]
+
+    def is_due_for_disk(self, key):
+        """Whether a memory entry has recurred often enough to be written
+        to disk, and has not been written yet.
+        """
+        if not self.disk_budget:
+            return False
+        with self._lock:
+            entry = self._memory.get(key)
+            return (
+                (entry is not None)
+                and (entry[1] >= AUDIO_CACHE_DISK_MIN_HITS)
+                and not entry[2]
+            )
+
+    def get_from_disk(self, key):
+        """Read an entry from disk and promote it to the memory tier.
+        This does file IO, so call it from a worker thread.
+        """
+        if not self.disk_budget:
+            return None
+        filename = self._get_filename(key)
+        try:
+            # The memory tier keeps `bytes`, so mapping the file would
+            # only add a copy
+            pcm = filename.read_bytes()
+        except OSError:
+            # Missing file
+            return None
+        if not pcm:
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(filename)
+        self._put_in_memory(key, pcm, on_disk=True)
+        return pcm
+
+    def get(self, key):
+        pcm = self.get_from_memory(key)
+        if pcm is None:
+            pcm = self.get_from_disk(key)
+        return pcm
+
+    def put(self, key, pcm):
+        """Add an entry to the memory tier."""
+        if pcm:
+            self._put_in_memory(key, pcm)
+
+    def write_to_disk(self, key):
+        """Write a memory entry to the disk tier, see `is_due_for_disk`.
+        Writing, and pruning the disk tier if it is over budget, is done
+        in the calling thread.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if (entry is None) or entry[2]:
+                return
+            entry[2] = True
+            pcm = entry[0]
+        filename = self._get_filename(key)
+        if filename.exists():
+            return
+        tmp_filename = filename.with_suffix(".tmp")
+        try:
+            tmp_filename.write_bytes(pcm)
+            os.replace(tmp_filename, filename)
+        except OSError:
+            log.debug("Failed to write audio cache entry", exc_info=True)
+            with contextlib.suppress(OSError):
+                tmp_filename.unlink()
+            return
+        with self._lock:
+            self._disk_size += len(pcm)
+            over_budget = self._disk_size > self.disk_budget
+        if over_budget:
+            self.prune_disk()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            self._disk_size = 0
+        for filename in self.cache_dir.glob(f"*{PCM_FILE_SUFFIX}"):
+            with contextlib.suppress(OSError):
+                filename.unlink()
+
+    def prune_disk(self):
+        """If the disk tier is over its budget, remove the least recently used
+        files until it fits `AUDIO_CACHE_DISK_PRUNE_RATIO` of the budget.
+        """
+        if not self._prune_lock.acquire(blocking=False):
+            # Another thread is pruning
+            return
+        try:
+            self._prune_disk()
+        finally:
+            self._prune_lock.release()
+
+    def _prune_disk(self):
+        try:
+            entries = [
+                (entry.stat().st_mtime, entry.stat().st_size, entry)
+                for entry in self.cache_dir.glob(f"*{PCM_FILE_SUFFIX}")
+            ]
+        except OSError:
+            return
+        total_size = sum(size for (__, size, __) in entries)
+        if total_size > self.disk_budget:
+            target_size = self.disk_budget * AUDIO_CACHE_DISK_PRUNE_RATIO
+            entries.sort(key=lambda e: e[0])
+            for (__, size, entry) in entries:
+                with contextlib.suppress(OSError):
+                    entry.unlink()
+                    total_size -= size
+                if total_size <= target_size:
+                    break
+        with self._lock:
+            self._disk_size = total_size
+
+    def _put_in_memory(self, key, pcm, on_disk=False):
+        pcm_size = len(pcm)
+        if pcm_size > self.memory_budget:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = [pcm, 0, on_disk]
+            self._memory_size += pcm_size
+            while self._memory_size > self.memory_budget:
+                __, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted[0])
+
+    def _get_filename(self, key):
+        return self.cache_dir.joinpath(key).with_suffix(PCM_FILE_SUFFIX)
@@ -0,0 +1,294 @@
+# coding: utf-8
+
+# Copyright (c) 2023 Musharraf Omer
+# This file is covered by the GNU General Public License.
+
+"""Feeds a `WavePlayer` from a dedicated thread.
+
+The asyncio side copies PCM into a preallocated ring buffer and returns
+at once. A single long-lived thread per player drains the ring buffer
+into `WavePlayer.feed`, which may block. The player is given pointers
+into the ring buffer, so audio is not copied again before the player
+takes its own copy; a region is only reused once `feed` has returned.
+
+Markers record a byte offset in the audio stream. Regions are cut at
+marker offsets, and the marker callbacks are given to the player as the
+`onDone` callback of the region that ends at the marker, so they are
+called when the audio before the marker has played.
+
+The player is also idled from the feeder thread, so that `idle` is never
+called while the thread is feeding the player.
+"""
+
+import asyncio
+import ctypes
+import threading
+import time
+
+from logHandler import log
+
+from functools import partial
+
+from .const import AUDIO_RING_BUFFER_SIZE, AUDIO_FEED_CHUNK_SIZE
+
+
+class AudioFeeder:
+    __slots__ = [
+        "player",
+        "loop",
+        "_buffer",
+        "_buffer_view",
+        "_buffer_address",
+        "_capacity",
+        "_read_pos",
+        "_size",
+        "_in_flight",
+        "_written_total",
+        "_fed_total",
+        "_generation",
+        "_closed",
+        "_idle_requested",
+        "_condition",
+        "_space_available",
+        "_fed_callbacks",
+        "_markers",
+        "_silence",
+        "_thread",
+        "_bytes_per_second",
+        "_play_end",
+    ]
+
+    def __init__(
+        self,
+        player,
+        loop,
+        capacity=AUDIO_RING_BUFFER_SIZE,
+        name="audio_feeder",
+        bytes_per_second=None,
+    ):
+        self.player = player
+        self.loop = loop
+        self._bytes_per_second = bytes_per_second
+        # When the audio queued so far will have finished playing
+        self._play_end = 0.0
+        self._buffer = ctypes.create_string_buffer(capacity)
+        self._buffer_view = memoryview(self._buffer).cast("B")
+        self._buffer_address = ctypes.addressof(self._buffer)
+        self._capacity = capacity
+        self._read_pos = 0
+        self._size = 0
+        # Bytes at `_read_pos` being read by the player
+        self._in_flight = 0
+        self._written_total = 0
+        self._fed_total = 0
+        self._generation = 0
+        self._closed = False
+        self._idle_requested = False
+        self._condition = threading.Condition()
+        self._space_available = asyncio.Event()
+        self._fed_callbacks = []
+        # `(offset, callback)` ordered by offset
+        self._markers = []
+        # Fed to the player for markers whose audio has already been fed
+        self._silence = ctypes.create_string_buffer(2)
+        self._thread = threading.Thread(
+            target=self._feeder_thread_target, daemon=True, name=f"piper4nvda_{name}"
+        )
+        self._thread.start()
+
+    async def feed(self, data):
+        """Queue audio for playback. Must be called from the event loop."""
+        view = memoryview(data).cast("B")
+        if self._bytes_per_second:
+            self._play_end = (
+                max(self._play_end, time.perf_counter())
+                + len(view) / self._bytes_per_second
+            )
+        while view:
+            written = self._write(view)
+            view = view[written:]
+            if view:
+                await self._space_available.wait()
+
+    def get_starved_seconds(self):
+        """Return how long ago the queued audio finished playing, assuming
+        playback started when the audio was queued. Zero while audio is
+        still playing, or if the audio was cleared.
+        """
+        if not self._play_end:
+            return 0.0
+        return max(time.perf_counter() - self._play_end, 0.0)
+
+    def is_playing(self):
+        """Whether the audio queued so far is still playing, assuming
+        playback started when the audio was queued.
+        """
+        return self._play_end > time.perf_counter()
+
+    def add_fed_callback(self, callback):
+        """Call `callback` from the feeder thread once all audio queued so far
+        has been handed to the player. Dropped if the audio is cleared.
+        """
+        with self._condition:
+            if self._fed_total >= self._written_total:
+                run_now = True
+            else:
+                run_now = False
+                self._fed_callbacks.append((self._written_total, callback))
+        if run_now:
+            callback()
+
+    def add_marker(self, callback):
+        """Call `callback` from the player once all audio queued so far has
+        played. Dropped if the audio is cleared.
+        """
+        with self._condition:
+            self._markers.append((self._written_total, callback))
+            self._condition.notify()
+
+    def request_idle(self):
+        """Idle the player from the feeder thread, unless more audio has
+        been queued by then. Called once the queued audio has played, so
+        that idling does not wait for playback.
+        """
+        with self._condition:
+            self._idle_requested = True
+            self._condition.notify()
+
+    def clear(self):
+        """Drop any audio that has not been handed to the player yet."""
+        self._play_end = 0.0
+        with self._condition:
+            self._generation += 1
+            # Keep the region the player is reading from until it is done
+            self._size = self._in_flight
+            self._fed_total = self._written_total
+            self._fed_callbacks = []
+            self._markers = []
+            self._idle_requested = False
+        self._notify_space_available()
+
+    def stop(self):
+        self.clear()
+        self.player.stop()
+
+    def close(self):
+        self.clear()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout=1)
+
+    def _write(self, view):
+        with self._condition:
+            free = self._capacity - self._size
+            count = min(free, len(view))
+            if count:
+                write_pos = (self._read_pos + self._size) % self._capacity
+                first_part = min(count, self._capacity - write_pos)
+                buffer_view = self._buffer_view
+                buffer_view[write_pos:write_pos + first_part] = view[:first_part]
+                if first_part < count:
+                    buffer_view[:count - first_part] = view[first_part:count]
+                self._size += count
+                self._written_total += count
+                self._condition.notify()
+            if count < len(view):
+                self._space_available.clear()
+        return count
+
+    def _feeder_thread_target(self):
+        while True:
+            with self._condition:
+                while (
+                    (not self._closed)
+                    and (self._size < 2)
+                    and not self._has_fed_markers()
+                    and not self._idle_requested
+                ):
+                    self._condition.wait()
+                if self._closed:
+                    return
+                if self._idle_requested:
+                    self._idle_requested = False
+                    if (self._size < 2) and not self._markers:
+                        should_idle = True
+                    else:
+                        # More audio is coming, keep the player open
+                        should_idle = False
+                else:
+                    should_idle = None
+            if should_idle:
+                try:
+                    self.player.idle()
+                except Exception:
+                    log.exception("Failed to idle the player", exc_info=True)
+            if should_idle is not None:
+                continue
+            with self._condition:
+                generation = self._generation
+                if self._has_fed_markers():
+                    # The audio before these markers was fed without them
+                    on_done = self._pop_markers(self._fed_total, generation)
+                    data = ctypes.c_void_p(ctypes.addressof(self._silence))
+                    count = 0
+                else:
+                    # Feed a contiguous region, aligned on 16-bit samples,
+                    # which ends at the next marker if there is one
+                    contiguous = min(self._size, self._capacity - self._read_pos)
+                    if self._markers and (self._markers[0][0] > self._fed_total):
+                        contiguous = min(contiguous, self._markers[0][0] - self._fed_total)
+                    count = min(contiguous, AUDIO_FEED_CHUNK_SIZE) & ~1 or contiguous
+                    data = ctypes.c_void_p(self._buffer_address + self._read_pos)
+                    on_done = self._pop_markers(self._fed_total + count, generation)
+                    self._in_flight = count
+            try:
+                self.player.feed(data, count or len(self._silence), onDone=on_done)
+            except Exception:
+                log.exception("Failed to feed audio to the player", exc_info=True)
+            if not count:
+                continue
+            with self._condition:
+                self._in_flight = 0
+                self._read_pos = (self._read_pos + count) % self._capacity
+                self._size -= count
+                if generation != self._generation:
+                    continue
+                self._fed_total += count
+                fed_total = self._fed_total
+                callbacks = [c for c in self._fed_callbacks if c[0] <= fed_total]
+                self._fed_callbacks = [c for c in self._fed_callbacks if c[0] > fed_total]
+            self._notify_space_available()
+            for (__, callback) in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    log.exception("Error in audio feeder callback", exc_info=True)
+
+    def _has_fed_markers(self):
+        return bool(self._markers) and (self._markers[0][0] <= self._fed_total)
+
+    def _pop_markers(self, offset, generation):
+        """Remove the markers up to `offset`, and return a callback that calls
+        them, or None if there are no such markers.
+        """
+        callbacks = []
+        while self._markers and (self._markers[0][0] <= offset):
+            callbacks.append(self._markers.pop(0)[1])
+        if not callbacks:
+            return None
+        return partial(self._call_markers, callbacks, generation)
+
+    def _call_markers(self, callbacks, generation):
+        # Audio that was cleared may still finish playing
+        if generation != self._generation:
+            return
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                log.exception("Error in audio feeder marker callback", exc_info=True)
+
+    def _notify_space_available(self):
+        self.loop.call_soon_threadsafe(self._space_available.set)
+
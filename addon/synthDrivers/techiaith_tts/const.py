@@ -8,11 +8,62 @@ __all__ = [
     "PIPER_VOICES_VERSION",
     "TECHIAITH_VOICES_BASE_DIR",
     "TECHIAITH_VOICES_DIR",
+    "VOICE_INDEX_FILE",
+    "VOICE_MEMORY_FACTOR",
     "BATCH_SIZE",
     "FALLBACK_SPEAKER_NAME",
     "DEFAULT_RATE",
     "DEFAULT_VOLUME",
     "DEFAULT_PITCH",
+    "DEFAULT_SAMPLE_RATE",
+    "DEFAULT_LENGTH_SCALE",
+    "DEFAULT_NOISE_SCALE",
+    "DEFAULT_NOISE_W",
+    "GRPC_SERVER_STARTUP_TIMEOUT",
+    "GRPC_SERVER_START_ATTEMPTS",
+    "GRPC_RECONNECT_BACKOFF_MS",
+    "GRPC_TRANSPORTS",
+    "GRPC_SERVER_SOCKET_PATH",
+    "GRPC_TRANSPORT_FALLBACK_TIMEOUT",
+    "GRPC_CHANNEL_PROFILES",
+    "GRPC_MAX_MESSAGE_LENGTH",
+    "GRPC_STREAM_WINDOW_SIZE",
+    "GRPC_KEEPALIVE_TIME_MS",
+    "GRPC_KEEPALIVE_TIMEOUT_MS",
+    "GRPC_HEALTH_CHECK_INTERVAL",
+    "GRPC_HEALTH_CHECK_TIMEOUT",
+    "GRPC_HEALTH_CHECK_FAILURES",
+    "GRPC_RESTART_BACKOFF_MIN",
+    "GRPC_RESTART_BACKOFF_MAX",
+    "GRPC_RESTART_BACKOFF_RESET",
+    "SYNTHESIS_MODE_AUTO",
+    "SYNTHESIS_MODES",
+    "LAZY_MODE_MAX_CHARS",
+    "BATCHED_MODE_MIN_CHARS",
+    "SEGMENT_FIRST_MAX_CHARS",
+    "SEGMENT_MAX_CHARS",
+    "SEGMENT_GROWTH_FACTOR",
+    "AUDIO_CACHE_DIR",
+    "AUDIO_CACHE_MEMORY_BUDGET",
+    "AUDIO_CACHE_DISK_BUDGET",
+    "AUDIO_CACHE_DISK_PRUNE_RATIO",
+    "AUDIO_CACHE_DISK_MIN_HITS",
+    "AUDIO_CACHE_MAX_TEXT_CHARS",
+    "LOOKAHEAD_MAX_CHUNKS",
+    "SPEECH_MAX_SYNTHESIZING_SEQUENCES",
+    "AUDIO_RING_BUFFER_SIZE",
+    "AUDIO_FEED_CHUNK_SIZE",
+    "SPEECH_METRICS_SAMPLES",
+    "SPEECH_METRICS_LOG_INTERVAL",
+    "VOICE_WARM_UP_TEXTS",
+    "ADAPTIVE_RTF_HIGH",
+    "ADAPTIVE_RTF_LOW",
+    "ADAPTIVE_RTF_MIN_SAMPLES",
+    "ADAPTIVE_RTF_SMOOTHING",
+    "ADAPTIVE_UNDERRUN_LIMIT",
+    "ADAPTIVE_UNDERRUN_WINDOW",
+    "ADAPTIVE_UNDERRUN_TOLERANCE",
+    "ADAPTIVE_MIN_DWELL",
 ]
 
 
@@ -27,8 +78,101 @@ TECHIAITH_VOICES_BASE_DIR = os.path.join(globalVars.appArgs.configPath, "techiai
 TECHIAITH_VOICES_DIR = os.path.join(
     TECHIAITH_VOICES_BASE_DIR, "voices", "piper"
 )
+# Caches the list of installed voices and their parsed configs
+VOICE_INDEX_FILE = os.path.join(TECHIAITH_VOICES_BASE_DIR, "voices-index.json")
+# Estimated server memory used by a loaded voice, relative to its model file size
+VOICE_MEMORY_FACTOR = 1.5
+# Maximum number of concurrent synthesis requests for one utterance
 BATCH_SIZE = max(os.cpu_count() // 2, 2)
+# Text is synthesized in segments of growing size, see `segmenter`.
+# The first segment is short so that speech starts sooner
+SEGMENT_FIRST_MAX_CHARS = 60
+SEGMENT_MAX_CHARS = 400
+SEGMENT_GROWTH_FACTOR = 2
 FALLBACK_SPEAKER_NAME = "default"
 DEFAULT_RATE = 50
 DEFAULT_VOLUME = 100
 DEFAULT_PITCH = 50
+# Piper's defaults, used when a voice config does not specify them
+DEFAULT_SAMPLE_RATE = 22050
+DEFAULT_LENGTH_SCALE = 1.0
+DEFAULT_NOISE_SCALE = 0.667
+DEFAULT_NOISE_W = 0.8
+# Seconds to wait for the gRPC server to accept connections
+GRPC_SERVER_STARTUP_TIMEOUT = 15
+# Times the server is started on a new port if it exits during startup
+GRPC_SERVER_START_ATTEMPTS = 3
+# Reconnect backoff for the channel to the local server
+GRPC_RECONNECT_BACKOFF_MS = 100
+# Channel transports to the local server. `unix` uses a Unix domain
+# socket, which Windows supports since Windows 10 version 1803
+GRPC_TRANSPORTS = ("tcp", "unix")
+GRPC_SERVER_SOCKET_PATH = os.path.join(TECHIAITH_VOICES_BASE_DIR, "sonata-grpc.sock")
+# Seconds to wait for a non TCP transport before falling back to TCP
+GRPC_TRANSPORT_FALLBACK_TIMEOUT = 3
+# Named sets of channel options, see `grpc_client.CHANNEL_PROFILES`
+GRPC_CHANNEL_PROFILES = ("low_latency", "default")
+# Long sentences are returned as a single message
+GRPC_MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+# A fixed HTTP/2 stream window large enough for several seconds of audio
+GRPC_STREAM_WINDOW_SIZE = 4 * 1024 * 1024
+# Ping the server during synthesis to detect a hung stream
+GRPC_KEEPALIVE_TIME_MS = 10000
+GRPC_KEEPALIVE_TIMEOUT_MS = 3000
+# Server supervision: seconds between health checks, the timeout of each
+# check, and how many checks must fail before the server is restarted
+GRPC_HEALTH_CHECK_INTERVAL = 5
+GRPC_HEALTH_CHECK_TIMEOUT = 3
+GRPC_HEALTH_CHECK_FAILURES = 2
+# Seconds to wait before restarting the server, doubled on each restart and
+# reset once the server has been running for `GRPC_RESTART_BACKOFF_RESET`
+GRPC_RESTART_BACKOFF_MIN = 0.5
+GRPC_RESTART_BACKOFF_MAX = 30
+GRPC_RESTART_BACKOFF_RESET = 60
+# Server side synthesis modes, `auto` lets the driver choose per utterance
+SYNTHESIS_MODE_AUTO = "auto"
+SYNTHESIS_MODES = ("lazy", "parallel", "batched")
+# Utterances up to this length are synthesized lazily for the fastest first audio
+LAZY_MODE_MAX_CHARS = 80
+# During say-all, utterances at least this long are synthesized in batched mode
+BATCHED_MODE_MIN_CHARS = 600
+# Synthesized audio cache
+AUDIO_CACHE_DIR = os.path.join(TECHIAITH_VOICES_BASE_DIR, "cache", "audio")
+AUDIO_CACHE_MEMORY_BUDGET = 16 * 1024 * 1024
+AUDIO_CACHE_DISK_BUDGET = 128 * 1024 * 1024
+# Once over budget, the disk tier is pruned to this fraction of it, so that
+# it is not pruned again on every write
+AUDIO_CACHE_DISK_PRUNE_RATIO = 0.75
+# Only entries hit this many times in memory are written to disk, so that
+# one-off screen content (chat lines, codes) is not persisted
+AUDIO_CACHE_DISK_MIN_HITS = 2
+# Only short utterances (control names, roles, menu items) are cached
+AUDIO_CACHE_MAX_TEXT_CHARS = 64
+# Maximum number of audio chunks synthesized ahead of playback
+LOOKAHEAD_MAX_CHUNKS = 64
+# Queued speech is synthesized ahead of playback once fewer than this
+# many sequences before it are still being synthesized
+SPEECH_MAX_SYNTHESIZING_SEQUENCES = 1
+# Audio queued between the event loop and the player's feeder thread
+AUDIO_RING_BUFFER_SIZE = 512 * 1024
+AUDIO_FEED_CHUNK_SIZE = 32 * 1024
+# Number of recent samples of each latency measurement kept for percentiles
+SPEECH_METRICS_SAMPLES = 200
+# Log a metrics summary every this many utterances (debug logging only)
+SPEECH_METRICS_LOG_INTERVAL = 20
+# Synthesized and discarded after a voice is loaded, so that the first real
+# utterance does not pay for model and phonemizer initialization
+VOICE_WARM_UP_TEXTS = ("Helo.", "Mae'r llais yn barod, 1 2 3.")
+# Adaptive variant: use the fast variant once the standard variant's smoothed
+# real-time factor exceeds `ADAPTIVE_RTF_HIGH`, or after `ADAPTIVE_UNDERRUN_LIMIT`
+# underruns within `ADAPTIVE_UNDERRUN_WINDOW` seconds. Go back after at least
+# `ADAPTIVE_MIN_DWELL` seconds, once it is projected to be below `ADAPTIVE_RTF_LOW`.
+ADAPTIVE_RTF_HIGH = 0.8
+ADAPTIVE_RTF_LOW = 0.5
+ADAPTIVE_RTF_MIN_SAMPLES = 5
+ADAPTIVE_RTF_SMOOTHING = 0.2
+ADAPTIVE_UNDERRUN_LIMIT = 2
+ADAPTIVE_UNDERRUN_WINDOW = 30
+ADAPTIVE_MIN_DWELL = 30
+# Seconds the player may run dry before it counts as an underrun
+ADAPTIVE_UNDERRUN_TOLERANCE = 0.05
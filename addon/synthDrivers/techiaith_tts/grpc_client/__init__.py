@@ -3,14 +3,38 @@
 import asyncio
 import atexit
 import os
+import re
 import subprocess
+import threading
 import time
+from contextlib import suppress
 from pathlib import Path
 
 import globalVars
 from logHandler import log
 
-from ..const import TECHIAITH_VOICES_BASE_DIR
+from .._config import TechiaithConfig
+from ..const import (
+    GRPC_CHANNEL_PROFILES,
+    GRPC_HEALTH_CHECK_FAILURES,
+    GRPC_HEALTH_CHECK_INTERVAL,
+    GRPC_HEALTH_CHECK_TIMEOUT,
+    GRPC_KEEPALIVE_TIME_MS,
+    GRPC_KEEPALIVE_TIMEOUT_MS,
+    GRPC_MAX_MESSAGE_LENGTH,
+    GRPC_RECONNECT_BACKOFF_MS,
+    GRPC_RESTART_BACKOFF_MAX,
+    GRPC_RESTART_BACKOFF_MIN,
+    GRPC_RESTART_BACKOFF_RESET,
+    GRPC_SERVER_START_ATTEMPTS,
+    GRPC_SERVER_SOCKET_PATH,
+    GRPC_SERVER_STARTUP_TIMEOUT,
+    GRPC_STREAM_WINDOW_SIZE,
+    GRPC_TRANSPORT_FALLBACK_TIMEOUT,
+    GRPC_TRANSPORTS,
+    TECHIAITH_VOICES_BASE_DIR,
+)
+from ..instrumentation import METRICS
 from ..helpers import BIN_DIRECTORY, find_free_port, import_bundled_library
 
 
@@ -23,16 +47,77 @@ with import_bundled_library():
 
 SONATA_GRPC_SERVER_PORT = None
 GRPC_SERVER_PROCESS = None
+# Whether the server was started by this add-on, and so can be restarted.
+# Stays set while a restart is starting a new process
+SERVER_OWNED = False
+# How the channel connects to the server, one of `GRPC_TRANSPORTS`
+TRANSPORT = "tcp"
 CHANNEL = None
 SONATA_GRPC_SERVICE = None
+# Resolves to the server version once the server accepts requests
+SERVER_READY = None
+# Set when the server's output says it is listening for connections
+SERVER_LISTENING = threading.Event()
+SERVER_LISTENING_PATTERN = re.compile(rb"listening|serving|started", re.IGNORECASE)
+# Seconds between checks that the server process is still running during startup
+SERVER_POLL_INTERVAL = 0.1
+# Set when the server process started by us exits
+SERVER_EXITED = asyncio.Event()
+# Coroutine functions called after the server has been restarted
+SERVER_RESTART_CALLBACKS = []
+SUPERVISOR_TASK = None
+# Set to ask the supervisor to restart the server, see `request_restart`
+RESTART_REQUESTED = asyncio.Event()
+# `(reason, future)` for each requested restart
+RESTART_REQUESTS = []
+# Retry quickly while the local server is starting
+RECONNECT_OPTIONS = (
+    ("grpc.initial_reconnect_backoff_ms", GRPC_RECONNECT_BACKOFF_MS),
+    ("grpc.min_reconnect_backoff_ms", GRPC_RECONNECT_BACKOFF_MS),
+    ("grpc.max_reconnect_backoff_ms", GRPC_RECONNECT_BACKOFF_MS * 10),
+)
+# Channel options for each of `GRPC_CHANNEL_PROFILES`
+CHANNEL_PROFILES = {
+    "default": RECONNECT_OPTIONS,
+    # The server is local, so favour getting the first chunk of audio out
+    # over sharing bandwidth fairly
+    "low_latency": RECONNECT_OPTIONS + (
+        ("grpc.max_receive_message_length", GRPC_MAX_MESSAGE_LENGTH),
+        ("grpc.max_send_message_length", GRPC_MAX_MESSAGE_LENGTH),
+        # Start with a large window instead of growing it from 64 KiB
+        ("grpc.http2.bdp_probe", 0),
+        ("grpc.http2.lookahead_bytes", GRPC_STREAM_WINDOW_SIZE),
+        ("grpc.default_compression_algorithm", grpc.Compression.NoCompression),
+        ("grpc.keepalive_time_ms", GRPC_KEEPALIVE_TIME_MS),
+        ("grpc.keepalive_timeout_ms", GRPC_KEEPALIVE_TIMEOUT_MS),
+        ("grpc.keepalive_permit_without_calls", 0),
+        ("grpc.http2.max_pings_without_data", 0),
+        # A single connection to a single server
+        ("grpc.lb_policy_name", "pick_first"),
+        ("grpc.use_local_subchannel_pool", 1),
+        ("grpc.enable_retries", 0),
+        ("grpc.enable_http_proxy", 0),
+    ),
+}
+SYNTHESIS_MODE_MAP = {
+    "lazy": msgs.MODE_LAZY,
+    "parallel": msgs.MODE_PARALLEL,
+    "batched": msgs.MODE_BATCHED,
+}
 
 
-def start_grpc_server():
-    global GRPC_SERVER_PROCESS, SONATA_GRPC_SERVER_PORT
-    if hasattr(globalVars, "SONATA_GRPC_SERVER_PORT"):
+def start_grpc_server(restart=False):
+    global GRPC_SERVER_PROCESS, SERVER_OWNED, SONATA_GRPC_SERVER_PORT, TRANSPORT
+    if not restart and hasattr(globalVars, "SONATA_GRPC_SERVER_PORT"):
         SONATA_GRPC_SERVER_PORT = globalVars.SONATA_GRPC_SERVER_PORT
         GRPC_SERVER_PROCESS = globalVars.GRPC_SERVER_PROCESS
+        SERVER_OWNED = GRPC_SERVER_PROCESS is not None
+        TRANSPORT = getattr(globalVars, "SONATA_GRPC_TRANSPORT", "tcp")
         return True
+    SERVER_OWNED = True
+    if GRPC_SERVER_PROCESS is not None:
+        GRPC_SERVER_PROCESS.kill()
+        GRPC_SERVER_PROCESS = None
     SONATA_GRPC_SERVER_PORT = find_free_port()
     grpc_server_exe = os.path.join(BIN_DIRECTORY, "sonata-grpc.exe")
     nvda_espeak_dir = os.path.join(globalVars.appDir, "synthDrivers")
@@ -42,25 +127,26 @@ def start_grpc_server():
         "SONATA_ESPEAKNG_DATA_DIRECTORY": os.fspath(nvda_espeak_dir),
         "SONATA_GRPC": "info",
     })
+    if TRANSPORT == "unix":
+        # The server also listens on TCP, which we fall back to if
+        # it does not support Unix domain sockets
+        with suppress(FileNotFoundError):
+            os.remove(GRPC_SERVER_SOCKET_PATH)
+        env["SONATA_GRPC_SERVER_SOCKET"] = GRPC_SERVER_SOCKET_PATH
     creationflags = (
         subprocess.DETACHED_PROCESS
         | subprocess.CREATE_NEW_PROCESS_GROUP
         | subprocess.REALTIME_PRIORITY_CLASS
     )
-    try:
-        server_log_file = os.path.join(TECHIAITH_VOICES_BASE_DIR, "logs", "sonata-grpc.log")
-        Path(server_log_file).parent.mkdir(parents=True, exist_ok=True)
-        server_stdout = open(server_log_file, "wb")
-    except:
-        log.exception("Failed to open server log file for writing", exc_info=True)
-        server_stdout = subprocess.DEVNULL
+    SERVER_LISTENING.clear()
+    SERVER_EXITED.clear()
     try:
         GRPC_SERVER_PROCESS = subprocess.Popen(
             args=grpc_server_exe,
             cwd=os.fspath(BIN_DIRECTORY),
             env=env,
             creationflags=creationflags,
-            stdout=server_stdout,
+            stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         )
     except:
@@ -69,27 +155,110 @@ def start_grpc_server():
             exc_info=True
         )
         return False
+    server_log_file = os.path.join(TECHIAITH_VOICES_BASE_DIR, "logs", "sonata-grpc.log")
+    threading.Thread(
+        target=_read_server_output,
+        args=(GRPC_SERVER_PROCESS, server_log_file),
+        name="piper4nvda_server_output",
+        daemon=True,
+    ).start()
     globalVars.SONATA_GRPC_SERVER_PORT = SONATA_GRPC_SERVER_PORT
     globalVars.GRPC_SERVER_PROCESS = GRPC_SERVER_PROCESS
+    globalVars.SONATA_GRPC_TRANSPORT = TRANSPORT
     return True
 
 
+def _read_server_output(process, server_log_file):
+    """Copy the server's output to its log file, watching for the line
+    that reports it is listening for connections.
+    """
+    try:
+        Path(server_log_file).parent.mkdir(parents=True, exist_ok=True)
+        log_file = open(server_log_file, "wb")
+    except:
+        log.exception("Failed to open server log file for writing", exc_info=True)
+        log_file = None
+    with process.stdout:
+        for line in process.stdout:
+            if log_file is not None:
+                try:
+                    log_file.write(line)
+                    log_file.flush()
+                except (OSError, ValueError):
+                    # Keep draining the output, or the server blocks writing to it
+                    log.exception("Failed to write to server log file", exc_info=True)
+                    with suppress(OSError):
+                        log_file.close()
+                    log_file = None
+            if not SERVER_LISTENING.is_set() and SERVER_LISTENING_PATTERN.search(line):
+                SERVER_LISTENING.set()
+    if log_file is not None:
+        with suppress(OSError):
+            log_file.close()
+    process.wait()
+    with suppress(RuntimeError):
+        aio.ASYNCIO_EVENT_LOOP.call_soon_threadsafe(_on_server_exited, process)
+
+
+def _on_server_exited(process):
+    # Processes replaced by a restart are expected to exit
+    if process is GRPC_SERVER_PROCESS:
+        SERVER_EXITED.set()
+
+
+def server_has_exited():
+    return (GRPC_SERVER_PROCESS is not None) and (GRPC_SERVER_PROCESS.poll() is not None)
+
+
+def get_server_address():
+    if TRANSPORT == "unix":
+        return f"unix:{GRPC_SERVER_SOCKET_PATH}"
+    return f"localhost:{SONATA_GRPC_SERVER_PORT}"
+
+
+def _open_channel():
+    global CHANNEL, SONATA_GRPC_SERVICE
+    CHANNEL = grpc.aio.insecure_channel(
+        get_server_address(), options=CHANNEL_PROFILES[_get_configured_channel_profile()]
+    )
+    SONATA_GRPC_SERVICE = sonata_grpcStub(CHANNEL)
+
+
+def _get_configured_transport():
+    transport = TechiaithConfig.get("transport", "tcp")
+    if transport not in GRPC_TRANSPORTS:
+        log.warning(f"Unknown Techiaith TTS transport `{transport}`, using TCP")
+        return "tcp"
+    return transport
+
+
+def _get_configured_channel_profile():
+    profile = TechiaithConfig.get("channel_profile", "low_latency")
+    if profile not in GRPC_CHANNEL_PROFILES:
+        log.warning(f"Unknown Techiaith TTS channel profile `{profile}`, using the default")
+        return "default"
+    return profile
+
+
 @aio.asyncio_coroutine_to_concurrent_future
 async def initialize():
-    global CHANNEL, SONATA_GRPC_SERVICE, SONATA_GRPC_SERVER_PORT
+    global TRANSPORT
+    TRANSPORT = _get_configured_transport()
     start_grpc_server()
     if CHANNEL is not None:
         log.warning("Attempted to re-initialize an already initialized GRPC connection")
         return
-    port = SONATA_GRPC_SERVER_PORT
-    CHANNEL = grpc.aio.insecure_channel(f"localhost:{port}")
-    SONATA_GRPC_SERVICE = sonata_grpcStub(CHANNEL)
+    _open_channel()
 
 
 @atexit.register
 def terminate():
-    global CHANNEL, GRPC_SERVER_PROCESS, SONATA_GRPC_SERVER_PORT
+    global CHANNEL, GRPC_SERVER_PROCESS, SERVER_OWNED, SONATA_GRPC_SERVER_PORT, SERVER_READY, SUPERVISOR_TASK
     SONATA_GRPC_SERVER_PORT = None
+    SERVER_READY = None
+    if SUPERVISOR_TASK is not None:
+        aio.asyncio_cancel_task(SUPERVISOR_TASK)
+        SUPERVISOR_TASK = None
     aio.terminate()
     if CHANNEL is not None:
         CHANNEL.close()
@@ -97,15 +266,236 @@ def terminate():
     if GRPC_SERVER_PROCESS is not None:
         GRPC_SERVER_PROCESS.terminate()
         GRPC_SERVER_PROCESS = None
+    SERVER_OWNED = False
 
 
-@aio.asyncio_coroutine_to_concurrent_future
-async def check_grpc_server(timeout=15) -> str:
-    return await asyncio.wait_for(get_sonata_version(), timeout)
+async def wait_until_ready(timeout=GRPC_SERVER_STARTUP_TIMEOUT) -> str:
+    """Wait until the server accepts requests, and return its version.
+    All callers share a single check, which is retried after a failure.
+    """
+    global SERVER_READY
+    if SERVER_READY is None:
+        SERVER_READY = asyncio.ensure_future(_connect(timeout))
+    try:
+        return await asyncio.shield(SERVER_READY)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        if SERVER_READY.done():
+            SERVER_READY = None
+        raise
+
+
+async def _connect(timeout):
+    start_time = time.perf_counter()
+    async with asyncio.timeout(timeout):
+        if TRANSPORT != "tcp":
+            await _fall_back_to_tcp_if_unavailable()
+        for attempt in range(GRPC_SERVER_START_ATTEMPTS):
+            if await _wait_for_channel_ready():
+                break
+            # Usually another process bound the port between `find_free_port`
+            # and the server starting, so try again on a new port
+            log.warning(
+                "Techiaith TTS GRPC server exited during startup "
+                f"with code {GRPC_SERVER_PROCESS.returncode}, restarting"
+            )
+            await _respawn_server()
+        else:
+            raise RuntimeError("Techiaith TTS GRPC server failed to start")
+        version = await get_sonata_version()
+    elapsed = (time.perf_counter() - start_time) * 1000
+    log.debug(f"Techiaith TTS GRPC server ready after {elapsed:.0f} ms")
+    return version
+
+
+async def _fall_back_to_tcp_if_unavailable():
+    global TRANSPORT
+    try:
+        async with asyncio.timeout(GRPC_TRANSPORT_FALLBACK_TIMEOUT):
+            if await _wait_for_channel_ready():
+                return
+    except TimeoutError:
+        pass
+    log.warning(f"Could not connect to {get_server_address()}, falling back to TCP")
+    TRANSPORT = "tcp"
+    globalVars.SONATA_GRPC_TRANSPORT = TRANSPORT
+    await CHANNEL.close()
+    _open_channel()
+
+
+async def _respawn_server():
+    if not start_grpc_server(restart=True):
+        raise RuntimeError("Failed to start Techiaith TTS GRPC server")
+    await CHANNEL.close()
+    _open_channel()
+
+
+async def restart_server():
+    """Start a new server process, and wait until it is ready."""
+    global SERVER_READY
+    # Replaced before respawning, so that callers wait for the new server
+    # rather than get the old server's readiness
+    SERVER_READY = asyncio.ensure_future(_respawn_and_connect())
+    return await wait_until_ready()
+
+
+async def _respawn_and_connect():
+    await _respawn_server()
+    return await _connect(GRPC_SERVER_STARTUP_TIMEOUT)
+
+
+def add_restart_callback(callback):
+    SERVER_RESTART_CALLBACKS.append(callback)
 
 
-async def get_sonata_version():
-    resp = await SONATA_GRPC_SERVICE.GetSonataVersion(msgs.Empty())
+def remove_restart_callback(callback):
+    with suppress(ValueError):
+        SERVER_RESTART_CALLBACKS.remove(callback)
+
+
+def start_supervisor():
+    """Start watching the server. Must be called from the event loop."""
+    global SUPERVISOR_TASK
+    if SUPERVISOR_TASK is None:
+        SUPERVISOR_TASK = asyncio.ensure_future(_supervise())
+
+
+async def request_restart(reason):
+    """Ask the supervisor to restart the server, and wait until it has
+    restarted and the restart callbacks have run. Must be called from the
+    event loop. Restarts requested at the same time, or while the server
+    is being restarted anyway, share a single restart.
+    """
+    future = asyncio.get_running_loop().create_future()
+    RESTART_REQUESTS.append((reason, future))
+    RESTART_REQUESTED.set()
+    start_supervisor()
+    await future
+
+
+async def _wait_for_restart_reason():
+    """Wait until the server exits, a restart is requested, or it is
+    time for the next health check.
+    """
+    waiters = [
+        asyncio.ensure_future(SERVER_EXITED.wait()),
+        asyncio.ensure_future(RESTART_REQUESTED.wait()),
+    ]
+    try:
+        await asyncio.wait(
+            waiters, timeout=GRPC_HEALTH_CHECK_INTERVAL, return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+
+async def _is_server_healthy():
+    try:
+        await asyncio.wait_for(get_sonata_version(), GRPC_HEALTH_CHECK_TIMEOUT)
+    except Exception:
+        return False
+    return True
+
+
+async def _supervise():
+    """Restart the server if it crashes, stops responding, or a restart
+    is requested, backing off exponentially if it keeps failing.
+    """
+    failed_checks = 0
+    restart_count = 0
+    last_restart_time = 0.0
+    while True:
+        await _wait_for_restart_reason()
+        if SERVER_EXITED.is_set():
+            reason = f"exited with code {GRPC_SERVER_PROCESS.returncode}"
+        elif RESTART_REQUESTED.is_set():
+            reason = f"must be restarted {RESTART_REQUESTS[0][0]}"
+        elif await _is_server_healthy():
+            failed_checks = 0
+            if time.monotonic() - last_restart_time >= GRPC_RESTART_BACKOFF_RESET:
+                restart_count = 0
+            continue
+        else:
+            failed_checks += 1
+            if failed_checks < GRPC_HEALTH_CHECK_FAILURES:
+                continue
+            reason = "is not responding"
+        # Any restart satisfies the restarts requested so far
+        requests = RESTART_REQUESTS[:]
+        RESTART_REQUESTS.clear()
+        RESTART_REQUESTED.clear()
+        if not SERVER_OWNED:
+            log.error(f"Techiaith TTS GRPC server {reason}, and was not started by this add-on")
+            failed_checks = 0
+            _resolve_restart_requests(requests, RuntimeError("The server cannot be restarted"))
+            continue
+        if SERVER_EXITED.is_set() or failed_checks:
+            delay = min(GRPC_RESTART_BACKOFF_MIN * (2 ** restart_count), GRPC_RESTART_BACKOFF_MAX)
+            restart_count += 1
+        else:
+            # A requested restart is not a failure
+            delay = 0
+        log.warning(f"Techiaith TTS GRPC server {reason}, restarting in {delay:.1f} seconds")
+        await asyncio.sleep(delay)
+        failed_checks = 0
+        last_restart_time = time.monotonic()
+        try:
+            await restart_server()
+        except Exception as e:
+            log.exception("Failed to restart Techiaith TTS GRPC server", exc_info=True)
+            _resolve_restart_requests(requests, e)
+            continue
+        log.info(f"Techiaith TTS GRPC server restarted on port {SONATA_GRPC_SERVER_PORT}")
+        for callback in list(SERVER_RESTART_CALLBACKS):
+            try:
+                await callback()
+            except Exception:
+                log.exception(f"Server restart callback {callback} failed", exc_info=True)
+        _resolve_restart_requests(requests)
+
+
+def _resolve_restart_requests(requests, exception=None):
+    for (__, future) in requests:
+        if future.done():
+            continue
+        if exception is None:
+            future.set_result(None)
+        else:
+            future.set_exception(exception)
+
+
+async def _wait_for_channel_ready():
+    """Wait until the channel is connected to the server.
+    Returns `False` if the server process exits first.
+    """
+    reopened = False
+    state = CHANNEL.get_state(try_to_connect=True)
+    while state is not grpc.ChannelConnectivity.READY:
+        if server_has_exited():
+            return False
+        if (
+            not reopened
+            and (state is grpc.ChannelConnectivity.TRANSIENT_FAILURE)
+            and SERVER_LISTENING.is_set()
+        ):
+            # The server says it is listening, connect now rather
+            # than when the channel's reconnect backoff expires
+            reopened = True
+            await CHANNEL.close()
+            _open_channel()
+        with suppress(TimeoutError):
+            async with asyncio.timeout(SERVER_POLL_INTERVAL):
+                await CHANNEL.wait_for_state_change(state)
+        state = CHANNEL.get_state(try_to_connect=True)
+    return True
+
+
+async def get_sonata_version(wait_for_ready=None):
+    resp = await SONATA_GRPC_SERVICE.GetSonataVersion(
+        msgs.Empty(), wait_for_ready=wait_for_ready
+    )
     return resp.version
 
 
@@ -138,7 +528,15 @@ async def set_synth_options(
 
 
 async def speak(
-    voice_id, text, rate=None, volume=None, pitch=None, appended_silence_ms=None, streaming=False
+    voice_id,
+    text,
+    rate=None,
+    volume=None,
+    pitch=None,
+    appended_silence_ms=None,
+    streaming=False,
+    synthesis_mode=None,
+    record_metrics=True,
 ):
     speech_args = None
     if any([rate, volume, pitch, appended_silence_ms]):
@@ -152,17 +550,39 @@ async def speak(
         voice_id=voice_id,
         text=text,
         speech_args=speech_args,
+        synthesis_mode=SYNTHESIS_MODE_MAP.get(synthesis_mode, msgs.MODE_UNSPECIFIED),
     )
     if streaming:
         stream = SONATA_GRPC_SERVICE.SynthesizeUtteranceRealtime
     else:
         stream = SONATA_GRPC_SERVICE.SynthesizeUtterance
-    async for ret in stream(utterance):
-        yield ret
+    request_time = time.perf_counter()
+    is_first_response = True
+    call = stream(utterance)
+    try:
+        async for ret in call:
+            if record_metrics:
+                if is_first_response:
+                    METRICS.record_elapsed("time_to_first_byte", request_time)
+                    is_first_response = False
+                # Only `SynthesisResult` carries the real-time factor
+                rtf = getattr(ret, "rtf", 0)
+                if rtf:
+                    METRICS.record("server_rtf", rtf)
+                METRICS.add_bytes_synthesized(len(ret.wav_samples))
+            yield ret
+    finally:
+        if not call.done():
+            # Abort the server side stream so that stale synthesis
+            # does not compete with new speech for server CPU
+            call.cancel()
+            await call.code()
 
 
 async def bench(n=10000):
-    initialize()
+    """Time `n` GetSonataVersion round trips. For end to end
+    measurements use `scripts/benchmark/run_benchmark.py`."""
+    await asyncio.wrap_future(initialize())
     t0 = time.perf_counter()
     for i in range(n):
         await get_sonata_version()
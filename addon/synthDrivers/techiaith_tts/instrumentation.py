@@ -0,0 +1,129 @@
+# coding: utf-8
+
+# Copyright (c) 2023 Musharraf Omer
+# This file is covered by the GNU General Public License.
+
+"""Latency instrumentation for the synth driver.
+
+Records time to first byte (first response to a synthesis request), time
+to first audio (from when speech starts from silence to the first PCM
+handed to the player), server real-time factor, bytes synthesized, queue
+depth, cancellations and underruns, and keeps rolling percentiles of each. Measurements are written to NVDA's log when the
+`synthDriver` debug logging category is enabled.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+
+import config
+from logHandler import log
+
+from .const import SPEECH_METRICS_SAMPLES, SPEECH_METRICS_LOG_INTERVAL
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def is_debug_logging_enabled():
+    try:
+        return config.conf["debugLog"]["synthDriver"]
+    except KeyError:
+        return False
+
+
+class RollingStats:
+    """Keeps the most recent `max_samples` values of a measurement."""
+
+    __slots__ = ["samples", "total_count"]
+
+    def __init__(self, max_samples=SPEECH_METRICS_SAMPLES):
+        self.samples = deque(maxlen=max_samples)
+        self.total_count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.total_count += 1
+
+    def percentile(self, percent):
+        """Nearest-rank percentile of the retained samples."""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        rank = max(math.ceil(percent / 100 * len(ordered)), 1)
+        return ordered[rank - 1]
+
+    def summary(self):
+        rv = {"count": self.total_count}
+        if self.samples:
+            for percent in PERCENTILES:
+                rv[f"p{percent}"] = round(self.percentile(percent), 3)
+            rv["max"] = round(max(self.samples), 3)
+        return rv
+
+
+class SpeechMetrics:
+    """Thread safe collection of speech latency measurements."""
+
+    MEASUREMENTS = (
+        # Milliseconds from sending a synthesis request to the first response
+        "time_to_first_byte",
+        # Milliseconds from speak() to the first PCM handed to the player
+        "time_to_first_audio",
+        # Server real-time factor reported in `SynthesisResult`
+        "server_rtf",
+        # Bytes of PCM per utterance
+        "bytes_per_utterance",
+        # Speech sequences in flight when speak() was called
+        "queue_depth",
+        # Milliseconds from cancel() until the speech has been torn down
+        "cancellation_latency",
+        # Milliseconds the player ran out of audio in the middle of speech
+        "underrun",
+    )
+
+    def __init__(self, max_samples=SPEECH_METRICS_SAMPLES):
+        self._lock = threading.Lock()
+        self._stats = {name: RollingStats(max_samples) for name in self.MEASUREMENTS}
+        self.bytes_synthesized = 0
+        self.cancellations = 0
+
+    def record(self, name, value):
+        with self._lock:
+            self._stats[name].add(value)
+            count = self._stats[name].total_count
+        if is_debug_logging_enabled():
+            log.debug(f"Techiaith TTS metrics: {name}={value:.3f}")
+            if (name == "time_to_first_audio") and (count % SPEECH_METRICS_LOG_INTERVAL == 0):
+                log.debug(f"Techiaith TTS metrics summary: {self.summary()}")
+
+    def record_elapsed(self, name, start_time):
+        self.record(name, (time.perf_counter() - start_time) * 1000)
+
+    def add_bytes_synthesized(self, count):
+        with self._lock:
+            self.bytes_synthesized += count
+
+    def add_cancellation(self, latency_ms):
+        with self._lock:
+            self.cancellations += 1
+        self.record("cancellation_latency", latency_ms)
+
+    def summary(self):
+        with self._lock:
+            rv = {name: stats.summary() for (name, stats) in self._stats.items()}
+            rv["bytes_synthesized"] = self.bytes_synthesized
+            rv["cancellations"] = self.cancellations
+        return rv
+
+    def reset(self):
+        with self._lock:
+            for stats in self._stats.values():
+                stats.samples.clear()
+                stats.total_count = 0
+            self.bytes_synthesized = 0
+            self.cancellations = 0
+
+
+METRICS = SpeechMetrics()
@@ -0,0 +1,215 @@
+# coding: utf-8
+
+# Copyright (c) 2023 Musharraf Omer
+# This file is covered by the GNU General Public License.
+
+"""Splits text into segments that are synthesized as separate requests.
+
+Sentences are found with rules for Welsh (and English) text, so that
+abbreviations, initials, numbered list items and quotations do not end a
+sentence. Sentences are then packed into segments of growing size: the
+first segment is short, and may end at a clause boundary, so that speech
+starts as soon as possible, while later segments are larger so that the
+server synthesizes them efficiently while the earlier ones play.
+"""
+
+import re
+
+from .const import (
+    SEGMENT_FIRST_MAX_CHARS,
+    SEGMENT_GROWTH_FACTOR,
+    SEGMENT_MAX_CHARS,
+)
+
+
+# Lowercase, without the final full stop
+ABBREVIATIONS = frozenset(
+    {
+        # Welsh
+        "e.e",  # er enghraifft
+        "h.y",  # hynny yw
+        "a.y.b",  # ac yn y blaen
+        "ayb",
+        "y.b",
+        "parch",  # parchedig
+        "cyf",  # cyfyngedig, cyfrol
+        "rhif",
+        "tud",  # tudalen
+        "td",
+        "gol",  # golygydd
+        "llsgr",  # llawysgrif
+        "ion",
+        "chwef",
+        "maw",
+        "ebr",
+        "meh",
+        "gorff",
+        "tach",
+        "rhag",
+        # English
+        "mr",
+        "mrs",
+        "ms",
+        "dr",
+        "prof",
+        "st",
+        "rev",
+        "etc",
+        "e.g",
+        "i.e",
+        "vs",
+        "cf",
+        "vol",
+        "pp",
+        "fig",
+    }
+)
+
+# Sentence ending punctuation, with any closing quotes and brackets
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"[.!?…]+[\"”»)\]]*\s+|\s*\n+\s*")
+# Clause ending punctuation
+CLAUSE_BOUNDARY_PATTERN = re.compile(r"[,;:–—][\"”»)\]]*\s+")
+WORD_BEFORE_PATTERN = re.compile(r"(\S+?)[.!?…]+[\"”»)\]]*$")
+LIST_MARKER_PATTERN = re.compile(r"(?:^|\n)\s*\d{1,2}$")
+
+
+def split_into_sentences(text):
+    """Split `text` into sentences, keeping the punctuation."""
+    return [sentence for (sentence, __) in _split(text, SENTENCE_BOUNDARY_PATTERN, _is_sentence_end)]
+
+
+def split_into_clauses(sentence):
+    """Split `sentence` at commas, semicolons, colons and dashes."""
+    return [clause for (clause, __) in _split(sentence, CLAUSE_BOUNDARY_PATTERN, _is_clause_end)]
+
+
+def split_into_segments(
+    text,
+    first_max_chars=SEGMENT_FIRST_MAX_CHARS,
+    max_chars=SEGMENT_MAX_CHARS,
+    growth_factor=SEGMENT_GROWTH_FACTOR,
+):
+    """Split `text` into segments of progressively larger size.
+    Segments are packed from whole sentences up to the size limit of their
+    position. A sentence longer than the limit is split into clauses, and a
+    clause longer than the limit is split between words. Sentences keep
+    the line breaks between them.
+    """
+    # `(sentence, separator)` pairs, in reverse order
+    pending = _split(text, SENTENCE_BOUNDARY_PATTERN, _is_sentence_end)
+    pending.reverse()
+    segments = []
+    limit = first_max_chars
+    while pending:
+        segment = []
+        length = 0
+        while pending:
+            (sentence, separator) = pending[-1]
+            if (length + len(sentence)) <= limit:
+                segment.append(pending.pop())
+                length += len(sentence) + 1
+                continue
+            if segment:
+                break
+            pending.pop()
+            (head, rest) = _split_long_sentence(sentence, limit)
+            segment.append((head, " "))
+            if rest:
+                pending.append((rest, separator))
+            break
+        segments.append(
+            "".join(part + separator for (part, separator) in segment[:-1]) + segment[-1][0]
+        )
+        limit = min(int(limit * growth_factor), max_chars)
+    return segments
+
+
+def _split_long_sentence(sentence, limit):
+    """Split `sentence` into a head of at most `limit` chars, ending at a
+    clause boundary if there is one, or between words otherwise, and the rest.
+    The head is longer than `limit` only if its first word is.
+    """
+    clauses = split_into_clauses(sentence)
+    # Take as many clauses as fit, at least one
+    taken = 1
+    taken_length = len(clauses[0])
+    while (taken < len(clauses)) and (taken_length + len(clauses[taken]) < limit):
+        taken_length += len(clauses[taken]) + 1
+        taken += 1
+    head = " ".join(clauses[:taken])
+    rest = " ".join(clauses[taken:])
+    if len(head) > limit:
+        words = head.split()
+        taken = 1
+        taken_length = len(words[0])
+        while (taken < len(words)) and (taken_length + len(words[taken]) < limit):
+            taken_length += len(words[taken]) + 1
+            taken += 1
+        head = " ".join(words[:taken])
+        rest = " ".join(words[taken:] + ([rest] if rest else []))
+    return (head, rest)
+
+
+def _split(text, pattern, is_boundary):
+    """Return `(part, separator)` pairs, where the separator is a line
+    break if the part ended at one, and a space otherwise.
+    """
+    parts = []
+    start = 0
+    for match in pattern.finditer(text):
+        if not is_boundary(text, start, match):
+            continue
+        part = (text[start:match.start()] + match.group().rstrip()).strip()
+        if part:
+            parts.append((part, "\n" if "\n" in match.group() else " "))
+        elif parts and ("\n" in match.group()):
+            parts[-1] = (parts[-1][0], "\n")
+        start = match.end()
+    rest = text[start:].strip()
+    if rest:
+        parts.append((rest, " "))
+    return parts
+
+
+def _is_sentence_end(text, start, match):
+    if "\n" in match.group():
+        return True
+    if _is_inside_quotation(text, start, match):
+        return False
+    following = text[match.end():match.end() + 1]
+    if following.islower():
+        # Only an abbreviation is followed by a lowercase word
+        return False
+    punctuation = match.group().rstrip()
+    if not punctuation.startswith("."):
+        return True
+    word_match = WORD_BEFORE_PATTERN.search(text, start, match.start() + len(punctuation))
+    if word_match is None:
+        return True
+    word = word_match.group(1).lstrip("\"“«([").lower()
+    if word in ABBREVIATIONS:
+        return False
+    if (len(word) == 1) and word.isalpha():
+        # An initial, as in "T. H. Parry-Williams"
+        return False
+    if word.isdigit() and LIST_MARKER_PATTERN.search(text, 0, match.start()):
+        # A numbered list item, as in "1. Cyflwyniad"
+        return False
+    return True
+
+
+def _is_clause_end(text, start, match):
+    return not _is_inside_quotation(text, start, match)
+
+
+def _is_inside_quotation(text, start, match):
+    """Whether `match` is inside a quotation. Quotations are kept whole,
+    unless they run for longer than a segment may be, which is also the
+    case when a quote is never closed.
+    """
+    if (match.start() - start) >= SEGMENT_MAX_CHARS:
+        return False
+    text = text[start:match.end()]
+    if text.count('"') % 2:
+        return True
+    return (text.count("“") > text.count("”")) or (text.count("«") > text.count("»"))
@@ -0,0 +1,115 @@
+# coding: utf-8
+
+# Copyright (c) 2023 Musharraf Omer
+# This file is covered by the GNU General Public License.
+
+"""Schedules speech from NVDA's main thread on the event loop.
+
+`submit` and `cancel` append to a queue and wake the event loop, and
+return at once, without waiting for the event loop to run the speech.
+The event loop runs the queued operations in order. Each cancel starts a
+new generation, and speech submitted in an earlier generation is dropped
+without being run, so a burst of key presses only speaks the last one.
+
+Submitted speech is spoken after the speech already queued, and never
+cancels it: NVDA cancels speech itself before it interrupts it. Cancel
+stops the speech in flight, including its server streams, and drops any
+queued speech. Queued speech is synthesized in the background while the
+speech before it plays, but only once fewer than
+`SPEECH_MAX_SYNTHESIZING_SEQUENCES` sequences before it are still being
+synthesized, so that it does not slow down the speech the user hears
+first, and the server always has the next piece of speech to work on.
+
+Only NVDA's main thread submits and cancels. The queue is a deque, so
+appending and popping from different threads needs no lock.
+"""
+
+import asyncio
+import time
+from collections import deque
+from functools import partial
+
+from .const import SPEECH_MAX_SYNTHESIZING_SEQUENCES
+from .instrumentation import METRICS
+
+
+class SpeechQueue:
+    def __init__(self, loop, process_sequence, on_cancelled=None):
+        self.loop = loop
+        # Coroutine function that speaks a sequence:
+        # `(speech_seq, previous_task, may_synthesize, synthesized)`
+        self.process_sequence = process_sequence
+        # Called in the event loop after speech has been cancelled
+        self.on_cancelled = on_cancelled
+        # Incremented by `cancel`
+        self.generation = 0
+        # `(generation, speech_seq, None)` to speak, or
+        # `(generation, None, cancel_time)` to cancel
+        self._pending = deque()
+        self._drain_scheduled = False
+        # Owned by the event loop
+        self._current_task = None
+        self._tasks = []
+        # Set once the synthesis of each queued sequence has finished, in order
+        self._synthesized_events = []
+
+    def submit(self, speech_seq):
+        """Queue `speech_seq` for speaking after the speech already queued."""
+        self._pending.append((self.generation, speech_seq, None))
+        self._schedule_drain()
+
+    def cancel(self):
+        """Drop queued speech and cancel the speech in flight."""
+        self.generation += 1
+        self._pending.append((self.generation, None, time.perf_counter()))
+        self._schedule_drain()
+
+    def _schedule_drain(self):
+        # Clearing the flag before draining means an entry appended
+        # while draining either gets drained or schedules another drain
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self.loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        self._drain_scheduled = False
+        while self._pending:
+            (generation, speech_seq, cancel_time) = self._pending.popleft()
+            if speech_seq is None:
+                self._cancel_tasks(cancel_time)
+            elif generation == self.generation:
+                self._start(speech_seq)
+
+    def _start(self, speech_seq):
+        previous_task = None
+        if (self._current_task is not None) and not self._current_task.done():
+            previous_task = self._current_task
+        self._synthesized_events = [e for e in self._synthesized_events if not e.is_set()]
+        may_synthesize = None
+        if len(self._synthesized_events) >= SPEECH_MAX_SYNTHESIZING_SEQUENCES:
+            may_synthesize = self._synthesized_events[-SPEECH_MAX_SYNTHESIZING_SEQUENCES]
+        synthesized = asyncio.Event()
+        self._synthesized_events.append(synthesized)
+        self._current_task = self.loop.create_task(
+            self.process_sequence(speech_seq, previous_task, may_synthesize, synthesized)
+        )
+        self._tasks = [t for t in self._tasks if not t.done()]
+        METRICS.record("queue_depth", len(self._tasks))
+        self._tasks.append(self._current_task)
+
+    def _cancel_tasks(self, cancel_time):
+        for task in self._tasks:
+            if not task.done():
+                task.add_done_callback(partial(_record_cancellation, cancel_time))
+                task.cancel()
+        self._tasks.clear()
+        self._synthesized_events.clear()
+        self._current_task = None
+        if self.on_cancelled is not None:
+            self.on_cancelled()
+
+
+def _record_cancellation(cancel_time, task):
+    """Record how long it took for cancelled speech, including its
+    server side streams, to be torn down."""
+    METRICS.add_cancellation((time.perf_counter() - cancel_time) * 1000)
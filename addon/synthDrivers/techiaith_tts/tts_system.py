@@ -3,22 +3,34 @@
 # Copyright (c) 2023 Musharraf Omer
 # This file is covered by the GNU General Public License.
 
+import asyncio
 import copy
+import math
 import operator
 import os
+import time
 from abc import ABC, abstractmethod
-from contextlib import contextmanager
-from dataclasses import dataclass, field
+from contextlib import aclosing, contextmanager
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import List, Mapping, Optional, Sequence, Union
+from typing import Mapping, Optional, Sequence
 
-import globalVars
 from languageHandler import normalizeLanguage
+from logHandler import log
 
 from . import aio
 from . import grpc_client
+from ._config import TechiaithConfig
+from .audio_cache import make_cache_key
 from .const import *
-from .helpers import import_bundled_library, LIB_DIRECTORY
+from .segmenter import split_into_segments
+from .voice_index import get_voice_index, read_voice_config
+from .variant_selector import VARIANT_SELECTOR
+from .voice_residency import VOICE_RESIDENCY
+
+
+# Voice key -> voice, for the voices being warmed up
+_WARMING_UP_VOICES = {}
 
 
 class VoiceNotFoundError(LookupError):
@@ -36,6 +48,30 @@ class Scales:
     noise_w: float
 
 
+@dataclass
+class SynthesisOptions:
+    """Client side copy of a voice's synthesis options on the server."""
+
+    speaker: Optional[str]
+    length_scale: float
+    noise_scale: float
+    noise_w: float
+
+
+def _synth_option_equals(value, server_value):
+    # The server stores the scales as 32-bit floats
+    if isinstance(value, float):
+        return math.isclose(value, server_value, rel_tol=1e-5)
+    return value == server_value
+
+
+def _log_synth_options_error(future):
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        log.error("Failed to set synthesis options", exc_info=future.exception())
+
+
 class AudioProvider(ABC):
     @abstractmethod
     def generate_audio(self) -> bytes:
@@ -58,11 +94,32 @@ class SilenceProvider(AudioProvider):
 class SpeechProvider(AudioProvider):
     """A pending request to speak some text."""
 
-    __slots__ = ["text", "speech_options"]
+    __slots__ = ["text", "speech_options", "cache_key", "fast_voice"]
 
-    def __init__(self, text, speech_options):
+    def __init__(self, text, speech_options, cache_key=None, fast_voice=None):
         self.text = text
         self.speech_options = speech_options
+        self.cache_key = cache_key
+        # The fast variant of the voice, if the variant is chosen adaptively
+        self.fast_voice = fast_voice
+
+    def select_variant(self):
+        """Switch to the fast variant if the standard variant cannot keep up.
+        Called when synthesis starts rather than when speech is queued, so that
+        speech queued ahead uses the latest measurements.
+        """
+        fast_voice = self.fast_voice
+        if fast_voice is None:
+            return
+        self.fast_voice = None
+        voice = self.speech_options.voice
+        if not VARIANT_SELECTOR.should_use_fast(voice, fast_voice):
+            return
+        if voice.speaker in fast_voice.speaker_names:
+            fast_voice.speaker = voice.speaker
+        self.speech_options.voice = fast_voice
+        if self.cache_key is not None:
+            self.cache_key = make_cache_key(fast_voice, self.speech_options, self.text)
 
     async def generate_audio(self):
         return await self.speech_options.speak_text(self.text)
@@ -78,6 +135,18 @@ class TechiaithVoice:
     properties: Optional[Mapping[str, int]] = field(default_factory=dict)
     remote_id: str = None
     supports_streaming_output: bool = False
+    # Option changes held back by `coalesce_synth_options`
+    _pending_synth_options = None
+    # Background synthesis started by `warm_up`
+    _warm_up_task = None
+    # The piper config file, set by `read_config`
+    config_path = None
+    # The name, size and modification time of the voice's files, set by `read_config`
+    model_identity = None
+    # The `LoadVoice` request in flight
+    _load_task = None
+    # The parsed piper config from the voice index, if any
+    indexed_config = None
 
     @classmethod
     def from_path(cls, path):
@@ -96,69 +165,252 @@ class TechiaithVoice:
             properties={"quality": quality.lower()},
         )
 
-    def load(self):
-        if self.remote_id:
+    def read_config(self):
+        """Read the sample rate, speakers and default scales from the
+        voice's piper config, without loading the voice on the server.
+        """
+        if self.config_path is not None:
             return
-        try:
-            self.config_path = next(self.location.glob("*.json"))
-        except StopIteration:
+        voice_config = self.indexed_config or read_voice_config(self.location)
+        if voice_config is None:
             raise RuntimeError(
                 f"Could not load voice from `{os.fspath(self.location)}`"
             )
-        voice_info = grpc_client.load_voice(
-            os.fspath(self.config_path)
-        ).result()
-        self.remote_id = voice_info.voice_id
-        self.supports_streaming_output = voice_info.supports_streaming_output
-        default_synth_options = voice_info.synth_options
-        self.default_scales = Scales(
-            length_scale=default_synth_options.length_scale,
-            noise_scale=default_synth_options.noise_scale,
-            noise_w=default_synth_options.noise_w,
+        speakers = {speaker_id: name for (speaker_id, name) in voice_config["speakers"]}
+        self._set_properties(
+            sample_rate=voice_config["sample_rate"],
+            speakers=speakers,
+            default_scales=Scales(
+                length_scale=voice_config["length_scale"],
+                noise_scale=voice_config["noise_scale"],
+                noise_w=voice_config["noise_w"],
+            ),
+            default_speaker=next(iter(speakers.values()), None),
+        )
+        self.synth_options = SynthesisOptions(
+            speaker=self.default_speaker,
+            length_scale=self.default_scales.length_scale,
+            noise_scale=self.default_scales.noise_scale,
+            noise_w=self.default_scales.noise_w,
         )
-        self.sample_rate = voice_info.audio.sample_rate
-        self.speakers = voice_info.speakers
+        self.config_path = Path(voice_config["config_path"])
+        try:
+            self.model_identity = tuple(sorted(
+                (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                for entry in os.scandir(self.location)
+                if entry.is_file()
+            ))
+        except OSError:
+            log.exception(f"Failed to read the files of voice {self.key}", exc_info=True)
+            self.model_identity = None
+
+    def _set_properties(self, sample_rate, speakers, default_scales, default_speaker):
+        self.sample_rate = sample_rate
+        self.speakers = speakers
         self.speaker_names = list(self.speakers.values())
         self.is_multi_speaker = bool(self.speakers)
         if self.is_multi_speaker:
-            self.default_speaker = default_synth_options.speaker
+            self.default_speaker = default_speaker
         else:
             self.default_speaker = None
+        self.default_scales = default_scales
+
+    def load_in_background(self):
+        if not self.remote_id:
+            future = asyncio.run_coroutine_threadsafe(
+                self.ensure_loaded(), aio.ASYNCIO_EVENT_LOOP
+            )
+            future.add_done_callback(self._log_load_error)
+
+    def _log_load_error(self, future):
+        if not future.cancelled() and (future.exception() is not None):
+            log.error(
+                f"Failed to load voice {self.key}", exc_info=future.exception()
+            )
+
+    async def ensure_loaded(self):
+        """Load the voice on the server if it is not loaded yet.
+        Concurrent callers share a single `LoadVoice` request.
+        """
+        if self.remote_id:
+            return
+        if self._load_task is None:
+            self._load_task = asyncio.ensure_future(self._load())
+        # Cancelling one waiter should not abort the load for the others
+        await asyncio.shield(self._load_task)
+
+    async def _load(self):
+        try:
+            self.read_config()
+            await VOICE_RESIDENCY.reserve(self)
+            await grpc_client.wait_until_ready()
+            voice_info = await asyncio.wrap_future(
+                grpc_client.load_voice(os.fspath(self.config_path))
+            )
+        except BaseException:
+            # Let the next caller try again, unless a newer load has
+            # replaced this one after `reset_remote_state`
+            if self._load_task is asyncio.current_task():
+                self._load_task = None
+                VOICE_RESIDENCY.discard(self)
+            raise
+        server_options = voice_info.synth_options
+        self._set_properties(
+            sample_rate=voice_info.audio.sample_rate,
+            speakers=dict(voice_info.speakers),
+            default_scales=Scales(
+                length_scale=server_options.length_scale,
+                noise_scale=server_options.noise_scale,
+                noise_w=server_options.noise_w,
+            ),
+            default_speaker=server_options.speaker,
+        )
+        self.supports_streaming_output = voice_info.supports_streaming_output
+        self.remote_id = voice_info.voice_id
+        await self.apply_synth_options(server_options)
+        if TechiaithConfig.get("warm_up_voices", True):
+            self.warm_up()
+
+    def reset_remote_state(self):
+        """Forget the voice's server side state, after the server restarted.
+        A load in progress is cancelled, as it may be for the old server.
+        """
+        self.remote_id = None
+        if self._load_task is not None:
+            self._load_task.cancel()
+        self._load_task = None
+
+    async def apply_synth_options(self, server_options):
+        """Send the options changed before the voice was loaded on the server."""
+        changed = {
+            name: value
+            for (name, value) in asdict(self.synth_options).items()
+            if (value is not None)
+            and not _synth_option_equals(value, getattr(server_options, name))
+        }
+        if changed:
+            await asyncio.wrap_future(
+                grpc_client.set_synth_options(self.remote_id, **changed)
+            )
+
+    def warm_up(self, texts=VOICE_WARM_UP_TEXTS):
+        """Synthesize a few short texts in the background and discard
+        the audio. Cancelled as soon as real speech uses any voice.
+        """
+        if texts:
+            aio.ASYNCIO_EVENT_LOOP.call_soon_threadsafe(self._start_warm_up, texts)
+
+    def cancel_warm_up(self):
+        """Must be called from the event loop."""
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+
+    def _start_warm_up(self, texts):
+        self.cancel_warm_up()
+        self._warm_up_task = asyncio.ensure_future(self._warm_up(texts))
+        _WARMING_UP_VOICES[self.key] = self
+
+    async def _warm_up(self, texts):
+        start_time = time.perf_counter()
+        try:
+            for text in texts:
+                stream = grpc_client.speak(
+                    voice_id=self.remote_id,
+                    text=text,
+                    streaming=self.supports_streaming_output,
+                    synthesis_mode="lazy",
+                    record_metrics=False,
+                )
+                async with aclosing(stream):
+                    async for __ in stream:
+                        pass
+        except asyncio.CancelledError:
+            log.debug(f"Warm up of voice {self.key} cancelled by speech")
+            raise
+        except Exception:
+            log.exception(f"Failed to warm up voice {self.key}", exc_info=True)
+        else:
+            elapsed = (time.perf_counter() - start_time) * 1000
+            log.debug(f"Warmed up voice {self.key} in {elapsed:.0f} ms")
+        finally:
+            if self._warm_up_task is asyncio.current_task():
+                self._warm_up_task = None
+                _WARMING_UP_VOICES.pop(self.key, None)
 
     @property
     def speaker(self):
         if self.is_multi_speaker:
-            return grpc_client.get_synth_options(self.remote_id).result().speaker
+            return self.synth_options.speaker
         return FALLBACK_SPEAKER_NAME
 
     @speaker.setter
     def speaker(self, value):
         if self.is_multi_speaker:
-            grpc_client.set_synth_options(self.remote_id, speaker=value).result()
+            self.update_synth_options(speaker=value)
 
     @property
     def noise_scale(self):
-        return grpc_client.get_synth_options(self.remote_id).result().noise_scale
+        return self.synth_options.noise_scale
 
     @noise_scale.setter
     def noise_scale(self, value):
-        grpc_client.set_synth_options(self.remote_id, noise_scale=value).result()
+        self.update_synth_options(noise_scale=value)
 
     @property
     def length_scale(self):
-        return grpc_client.get_synth_options(self.remote_id).result().length_scale
+        return self.synth_options.length_scale
 
     @length_scale.setter
     def length_scale(self, value):
-        grpc_client.set_synth_options(self.remote_id, length_scale=value).result()
+        self.update_synth_options(length_scale=value)
 
     @property
     def noise_w(self):
-        return grpc_client.get_synth_options(self.remote_id).result().noise_w
+        return self.synth_options.noise_w
 
     @noise_w.setter
     def noise_w(self, value):
-        grpc_client.set_synth_options(self.remote_id, noise_w=value).result()
+        self.update_synth_options(noise_w=value)
+
+    def update_synth_options(self, **options):
+        """Update the local synthesis options, and write the changed
+        fields through to the server in a single request.
+        """
+        changed = {
+            name: value
+            for (name, value) in options.items()
+            if getattr(self.synth_options, name) != value
+        }
+        if not changed:
+            return
+        for (name, value) in changed.items():
+            setattr(self.synth_options, name, value)
+        if self._pending_synth_options is not None:
+            self._pending_synth_options.update(changed)
+        else:
+            self._send_synth_options(changed)
+
+    @contextmanager
+    def coalesce_synth_options(self):
+        """Send all synthesis option changes made inside this block as one request."""
+        if self._pending_synth_options is not None:
+            yield
+            return
+        self._pending_synth_options = {}
+        try:
+            yield
+        finally:
+            changed = self._pending_synth_options
+            self._pending_synth_options = None
+            if changed:
+                self._send_synth_options(changed)
+
+    def _send_synth_options(self, changed):
+        if not self.remote_id:
+            # Sent by `apply_synth_options` once the voice has loaded
+            return
+        future = grpc_client.set_synth_options(self.remote_id, **changed)
+        future.add_done_callback(_log_synth_options_error)
 
     @property
     def is_fast(self):
@@ -176,9 +428,60 @@ class TechiaithVoice:
     def fast_variant_key(self):
         return TechiaithTextToSpeechSystem.get_voice_variants(self.key)[1]
 
-    async def synthesize(self, text, rate, volume, pitch, sentence_silence_ms):
+    @staticmethod
+    def select_synthesis_mode(text, is_say_all=False):
+        """Pick the server synthesis mode for an utterance.
+        Short utterances (focus changes, key echo) are synthesized lazily
+        to get the first audio out as soon as possible, while long say-all
+        text favours throughput.
+        """
+        text_length = len(text)
+        if text_length <= LAZY_MODE_MAX_CHARS:
+            return "lazy"
+        if is_say_all and (text_length >= BATCHED_MODE_MIN_CHARS):
+            return "batched"
+        return "parallel"
+
+    async def synthesize(
+        self,
+        text,
+        rate,
+        volume,
+        pitch,
+        sentence_silence_ms,
+        synthesis_mode=SYNTHESIS_MODE_AUTO,
+        is_say_all=False,
+    ):
         if (len(text) < 10) and (set(text.strip()).issubset(IGNORED_PUNCS)):
             return
+        await self.ensure_loaded()
+        VOICE_RESIDENCY.touch(self)
+        # Real speech takes priority over warming up any voice,
+        # such as the other variant preloaded with this one
+        cancel_warm_ups()
+        if synthesis_mode in (None, SYNTHESIS_MODE_AUTO):
+            synthesis_mode = self.select_synthesis_mode(text, is_say_all)
+        synth_args = dict(
+            rate=rate,
+            volume=volume,
+            pitch=pitch,
+            sentence_silence_ms=sentence_silence_ms,
+            synthesis_mode=synthesis_mode,
+        )
+        segments = split_into_segments(text)
+        if len(segments) > 1:
+            stream = self._synthesize_batch(segments, **synth_args)
+        else:
+            stream = self._synthesize_utterance(text, **synth_args)
+        # Voices are only evicted while no speech is being synthesized
+        with VOICE_RESIDENCY.synthesizing():
+            async with aclosing(stream):
+                async for wav_samples in stream:
+                    yield wav_samples
+
+    async def _synthesize_utterance(
+        self, text, rate, volume, pitch, sentence_silence_ms, synthesis_mode
+    ):
         stream = grpc_client.speak(
             voice_id=self.remote_id,
             text=text,
@@ -186,25 +489,96 @@ class TechiaithVoice:
             volume=volume,
             pitch=pitch,
             appended_silence_ms=sentence_silence_ms,
-            streaming=self.supports_streaming_output
+            streaming=self.supports_streaming_output,
+            synthesis_mode=synthesis_mode,
         )
-        async for ret in stream:
-            yield ret.wav_samples
+        async with aclosing(stream):
+            async for ret in stream:
+                rtf = getattr(ret, "rtf", 0)
+                if rtf:
+                    VARIANT_SELECTOR.record_rtf(self, rtf)
+                yield ret.wav_samples
+
+    async def _synthesize_batch(self, segments, **synth_args):
+        """Synthesize segments as concurrent requests, at most
+        `BATCH_SIZE` in flight, and yield the audio in the original order.
+        """
+        semaphore = asyncio.Semaphore(BATCH_SIZE)
+        queues = [asyncio.Queue() for _ in segments]
+
+        async def _producer(text, queue):
+            async with semaphore:
+                stream = self._synthesize_utterance(text, **synth_args)
+                try:
+                    async with aclosing(stream):
+                        async for wav_samples in stream:
+                            queue.put_nowait(wav_samples)
+                finally:
+                    queue.put_nowait(None)
+
+        tasks = [
+            asyncio.ensure_future(_producer(text, queue))
+            for (text, queue) in zip(segments, queues)
+        ]
+        try:
+            for (queue, task) in zip(queues, tasks):
+                while True:
+                    wav_samples = await queue.get()
+                    if wav_samples is None:
+                        break
+                    yield wav_samples
+                # Propagate errors raised by the request
+                await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Wait until every request has been torn down
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def cancel_warm_ups():
+    """Cancel the warm up of every voice. Must be called from the event loop."""
+    for voice in list(_WARMING_UP_VOICES.values()):
+        voice.cancel_warm_up()
 
 
 class SpeechOptions:
-    __slots__ = ["voice", "rate", "volume", "pitch", "sentence_silence_ms"]
+    __slots__ = [
+        "voice",
+        "rate",
+        "volume",
+        "pitch",
+        "sentence_silence_ms",
+        "synthesis_mode",
+        "is_say_all",
+    ]
 
-    def __init__(self, voice, speaker=None, rate=None, volume=None, pitch=None, sentence_silence_ms=None):
+    def __init__(
+        self,
+        voice,
+        speaker=None,
+        rate=None,
+        volume=None,
+        pitch=None,
+        sentence_silence_ms=None,
+        synthesis_mode=SYNTHESIS_MODE_AUTO,
+    ):
         self.voice = None
         self.set_voice(voice)
         self.rate = rate
         self.volume = volume
         self.pitch = pitch
         self.sentence_silence_ms = sentence_silence_ms
+        self.synthesis_mode = synthesis_mode
+        self.is_say_all = False
 
     def set_voice(self, voice: TechiaithVoice):
-        voice.load()
+        voice.read_config()
+        if self.voice is not None:
+            VOICE_RESIDENCY.unpin(self.voice)
+        # The voice in use is never evicted
+        VOICE_RESIDENCY.pin(voice)
+        voice.load_in_background()
         self.voice = voice
 
     @property
@@ -224,7 +598,9 @@ class SpeechOptions:
             self.rate,
             self.volume,
             self.pitch,
-            self.sentence_silence_ms
+            self.sentence_silence_ms,
+            self.synthesis_mode,
+            self.is_say_all,
         )
 
 
@@ -234,6 +610,8 @@ class TechiaithTextToSpeechSystem:
         self, voices: Sequence[TechiaithVoice], speech_options: SpeechOptions = None
     ):
         self.voices = voices
+        # Switch to the fast variant when the standard variant cannot keep up
+        self.adaptive_variant = False
         if speech_options is not None:
             self.speech_options = speech_options
         else:
@@ -245,14 +623,38 @@ class TechiaithTextToSpeechSystem:
 
     @contextmanager
     def create_synthesis_context(self):
-        """Reset speech params after each utterance."""
+        """Reset speech params after each utterance. If the utterance
+        switched voice, the voice in use is pinned again instead of the
+        voice it switched to.
+        """
         old_speech_options = self.speech_options.copy()
-        yield
-        self.speech_options = old_speech_options
+        try:
+            yield
+        finally:
+            voice = self.speech_options.voice
+            self.speech_options = old_speech_options
+            if voice is not old_speech_options.voice:
+                VOICE_RESIDENCY.unpin(voice)
+                VOICE_RESIDENCY.pin(old_speech_options.voice)
 
     def shutdown(self):
         pass
 
+    async def reload_voices(self):
+        """Load the voices that were loaded on a server that has since
+        been restarted, restoring their synthesis options.
+        """
+        loaded_voices = [voice for voice in self.voices if voice.remote_id]
+        for voice in loaded_voices:
+            voice.reset_remote_state()
+        results = await asyncio.gather(
+            *(voice.ensure_loaded() for voice in loaded_voices),
+            return_exceptions=True,
+        )
+        for (voice, result) in zip(loaded_voices, results):
+            if isinstance(result, Exception):
+                log.error(f"Failed to reload voice {voice.key}", exc_info=result)
+
     @property
     def voice(self) -> str:
         """Get the current voice key"""
@@ -347,6 +749,18 @@ class TechiaithTextToSpeechSystem:
         """Set the current speaking pitch in [0, 100]"""
         self.speech_options.pitch = new_pitch
 
+    @property
+    def synthesis_mode(self) -> str:
+        """Get the server synthesis mode, or `auto`"""
+        return self.speech_options.synthesis_mode or SYNTHESIS_MODE_AUTO
+
+    @synthesis_mode.setter
+    def synthesis_mode(self, new_mode: str):
+        """Set the server synthesis mode, or `auto` to choose per utterance"""
+        if (new_mode != SYNTHESIS_MODE_AUTO) and (new_mode not in SYNTHESIS_MODES):
+            raise ValueError(f"Unknown synthesis mode `{new_mode}`")
+        self.speech_options.synthesis_mode = new_mode
+
     def get_voices(self):
         return self.voices
 
@@ -364,26 +778,56 @@ class TechiaithTextToSpeechSystem:
         lang, name, quality = std_key.split("-")
         rt_key = f"{lang}-{name}+RT-{quality}"
         return std_key, rt_key
+
     def create_speech_provider(self, text):
-        return SpeechProvider(text, self.speech_options.copy())
+        speech_options = self.speech_options.copy()
+        voice = speech_options.voice
+        fast_voice = None
+        if self.adaptive_variant:
+            fast_voice = self._find_fast_variant(voice)
+        cache_key = None
+        if len(text) <= AUDIO_CACHE_MAX_TEXT_CHARS:
+            cache_key = make_cache_key(voice, speech_options, text)
+        return SpeechProvider(text, speech_options, cache_key, fast_voice)
+
+    def _find_fast_variant(self, voice):
+        """Return the fast variant of `voice` to switch to adaptively, if any."""
+        fast_voice = next(
+            (v for v in self.voices if v.key == voice.fast_variant_key), None
+        )
+        if (fast_voice is None) or (fast_voice is voice):
+            return None
+        fast_voice.read_config()
+        # Both variants have to play through the same player
+        if fast_voice.sample_rate != voice.sample_rate:
+            return None
+        return fast_voice
 
     def create_break_provider(self, time_ms):
         return SilenceProvider(time_ms, self.speech_options.voice.sample_rate)
 
     @classmethod
     def load_piper_voices_from_nvda_config_dir(cls):
-        Path(TECHIAITH_VOICES_DIR).mkdir(parents=True, exist_ok=True)
-        return sorted(
-            cls.load_voices_from_directory(TECHIAITH_VOICES_DIR),
-            key=operator.attrgetter("key"),
+        voice_index = get_voice_index()
+        voices = cls._create_voices(
+            Path(TECHIAITH_VOICES_DIR, name) for name in voice_index
         )
+        for voice in voices:
+            voice.indexed_config = voice_index[voice.key]
+        return sorted(voices, key=operator.attrgetter("key"))
 
     @classmethod
     def load_voices_from_directory(
         cls, voices_directory, *, directory_name_prefix="voice-"
     ):
+        return cls._create_voices(
+            d for d in Path(voices_directory).iterdir() if d.is_dir()
+        )
+
+    @staticmethod
+    def _create_voices(directories):
         rv = []
-        for directory in (d for d in Path(voices_directory).iterdir() if d.is_dir()):
+        for directory in directories:
             try:
                 voice = TechiaithVoice.from_path(directory)
             except ValueError:
@@ -393,4 +837,3 @@ class TechiaithTextToSpeechSystem:
                 continue
             rv.append(voice)
         return rv
-
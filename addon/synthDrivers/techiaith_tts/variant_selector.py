@@ -0,0 +1,129 @@
+# coding: utf-8
+
+# Copyright (c) 2023 Musharraf Omer
+# This file is covered by the GNU General Public License.
+
+"""Chooses between the standard and fast variant of a voice at run time.
+
+In the adaptive variant, speech uses the standard variant until the
+server cannot keep up with playback on this machine. That is detected
+from the real-time factor reported by the server and from underruns,
+where the player runs out of audio in the middle of speech. Speech then
+uses the fast variant, until the fast variant's real-time factor shows
+that the standard variant would keep up again.
+"""
+
+import threading
+import time
+from collections import deque
+
+from logHandler import log
+
+from .const import (
+    ADAPTIVE_MIN_DWELL,
+    ADAPTIVE_RTF_HIGH,
+    ADAPTIVE_RTF_LOW,
+    ADAPTIVE_RTF_MIN_SAMPLES,
+    ADAPTIVE_RTF_SMOOTHING,
+    ADAPTIVE_UNDERRUN_LIMIT,
+    ADAPTIVE_UNDERRUN_WINDOW,
+)
+
+
+class AdaptiveVariantSelector:
+    """Thread safe. Measurements are recorded from the event loop, and
+    the variant is chosen when the synthesis of each utterance starts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.use_fast = False
+        # Voice key -> `[smoothed_rtf, sample_count]`
+        self._rtf = {}
+        self._underrun_times = deque()
+        self._switch_time = 0.0
+        # Standard over fast real-time factor, measured after switching
+        self._rtf_ratio = None
+        self._standard_rtf_at_switch = None
+
+    def record_rtf(self, voice, rtf):
+        with self._lock:
+            stats = self._rtf.get(voice.key)
+            if stats is None:
+                self._rtf[voice.key] = [rtf, 1]
+            else:
+                stats[0] += ADAPTIVE_RTF_SMOOTHING * (rtf - stats[0])
+                stats[1] += 1
+
+    def record_underrun(self):
+        with self._lock:
+            self._underrun_times.append(time.monotonic())
+
+    def should_use_fast(self, standard_voice, fast_voice):
+        """Whether to synthesize the next utterance with `fast_voice`."""
+        with self._lock:
+            now = time.monotonic()
+            while self._underrun_times and (
+                now - self._underrun_times[0] > ADAPTIVE_UNDERRUN_WINDOW
+            ):
+                self._underrun_times.popleft()
+            underruns = len(self._underrun_times)
+            standard_rtf = self._get_rtf(standard_voice)
+            fast_rtf = self._get_rtf(fast_voice)
+            if not self.use_fast:
+                if (underruns >= ADAPTIVE_UNDERRUN_LIMIT) or (
+                    (standard_rtf is not None) and (standard_rtf > ADAPTIVE_RTF_HIGH)
+                ):
+                    log.info(
+                        f"Voice {standard_voice.key} cannot keep up "
+                        f"(rtf {_format_rtf(standard_rtf)}, {underruns} underruns), "
+                        f"using {fast_voice.key}"
+                    )
+                    self.use_fast = True
+                    self._switch_time = now
+                    self._standard_rtf_at_switch = standard_rtf
+                    self._rtf_ratio = None
+                    # Measure the fast variant under the current load
+                    self._rtf.pop(fast_voice.key, None)
+                    self._underrun_times.clear()
+            else:
+                if (
+                    (self._rtf_ratio is None)
+                    and (fast_rtf is not None)
+                    and self._standard_rtf_at_switch
+                ):
+                    self._rtf_ratio = self._standard_rtf_at_switch / max(fast_rtf, 0.01)
+                if (
+                    (now - self._switch_time >= ADAPTIVE_MIN_DWELL)
+                    and not underruns
+                    and ((self._rtf_ratio is None) or (fast_rtf is not None))
+                ):
+                    if self._rtf_ratio is None:
+                        # Switched because of underruns alone, try the standard variant again
+                        projected_rtf = None
+                    else:
+                        projected_rtf = fast_rtf * self._rtf_ratio
+                    if (projected_rtf is None) or (projected_rtf < ADAPTIVE_RTF_LOW):
+                        log.info(
+                            f"Voice {standard_voice.key} has headroom again "
+                            f"(projected rtf {_format_rtf(projected_rtf)}), using it"
+                        )
+                        self.use_fast = False
+                        self._switch_time = now
+                        # Measure the standard variant afresh
+                        self._rtf.pop(standard_voice.key, None)
+            return self.use_fast
+
+    def _get_rtf(self, voice):
+        """The smoothed real-time factor of `voice`, if there are enough samples."""
+        stats = self._rtf.get(voice.key)
+        if (stats is None) or (stats[1] < ADAPTIVE_RTF_MIN_SAMPLES):
+            return None
+        return stats[0]
+
+
+def _format_rtf(rtf):
+    return "unknown" if rtf is None else f"{rtf:.2f}"
+
+
+VARIANT_SELECTOR = AdaptiveVariantSelector()
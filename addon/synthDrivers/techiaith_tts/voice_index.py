@@ -0,0 +1,179 @@
+# coding: utf-8
+
+# Copyright (c) 2023 Musharraf Omer
+# This file is covered by the GNU General Public License.
+
+"""A persistent index of the installed voices.
+
+Discovering voices means listing the voices directory and parsing the
+piper config of every voice. The result is stored in a JSON file and
+reused for as long as the voices directory keeps the same modification
+time, which changes when a voice directory is added or removed.
+"""
+
+import contextlib
+import json
+import operator
+import os
+import threading
+from pathlib import Path
+
+from logHandler import log
+
+from .const import (
+    DEFAULT_LENGTH_SCALE,
+    DEFAULT_NOISE_SCALE,
+    DEFAULT_NOISE_W,
+    DEFAULT_SAMPLE_RATE,
+    TECHIAITH_VOICES_DIR,
+    VOICE_INDEX_FILE,
+)
+
+
+# Bump this to rebuild indexes written by older versions
+VOICE_INDEX_FORMAT_VERSION = 1
+
+_INDEX_LOCK = threading.Lock()
+# The last index read or written, with the file's modification time
+_INDEX_CACHE = None
+
+
+def read_voice_config(voice_dir):
+    """Parse the piper config of the voice in `voice_dir`.
+    Returns None if the voice has no config file.
+    """
+    try:
+        config_path = next(Path(voice_dir).glob("*.json"))
+    except StopIteration:
+        return None
+    with open(config_path, "r", encoding="utf-8") as file:
+        voice_config = json.load(file)
+    inference = voice_config.get("inference", {})
+    speaker_id_map = voice_config.get("speaker_id_map") or {}
+    return {
+        "config_path": os.fspath(config_path),
+        "sample_rate": voice_config.get("audio", {}).get(
+            "sample_rate", DEFAULT_SAMPLE_RATE
+        ),
+        # Pairs of `(speaker_id, name)` ordered by speaker ID
+        "speakers": sorted(
+            ((speaker_id, name) for (name, speaker_id) in speaker_id_map.items()),
+            key=operator.itemgetter(0),
+        ),
+        "length_scale": inference.get("length_scale", DEFAULT_LENGTH_SCALE),
+        "noise_scale": inference.get("noise_scale", DEFAULT_NOISE_SCALE),
+        "noise_w": inference.get("noise_w", DEFAULT_NOISE_W),
+        "language": voice_config.get("language", {}).get("code"),
+    }
+
+
+def get_voice_index():
+    """Return `{directory_name: metadata}` for every directory in the voices
+    directory, where `metadata` is the result of `read_voice_config`.
+    """
+    global _INDEX_CACHE
+    with _INDEX_LOCK:
+        voices_dir_mtime = _get_voices_dir_mtime()
+        index_mtime = _get_index_file_mtime()
+        if (
+            (_INDEX_CACHE is not None)
+            and (_INDEX_CACHE[0] == index_mtime)
+            and (_INDEX_CACHE[1]["voices_dir_mtime_ns"] == voices_dir_mtime)
+        ):
+            return _INDEX_CACHE[1]["voices"]
+        index = _read_index_file()
+        if (index is None) or (index["voices_dir_mtime_ns"] != voices_dir_mtime):
+            index = _build_index(voices_dir_mtime)
+        _INDEX_CACHE = (_get_index_file_mtime(), index)
+        return index["voices"]
+
+
+def update_voice_index():
+    """Rescan the voices directory and rewrite the index.
+    Call this after installing or removing a voice.
+    """
+    global _INDEX_CACHE
+    with _INDEX_LOCK:
+        index = _build_index(_get_voices_dir_mtime())
+        _INDEX_CACHE = (_get_index_file_mtime(), index)
+        return index["voices"]
+
+
+def try_update_voice_index():
+    """Call `update_voice_index` after a voice has been installed or removed,
+    logging a failure. Failing does not undo the change: the index is rebuilt
+    when it is next read, because the voices directory has changed.
+    """
+    try:
+        update_voice_index()
+    except Exception:
+        log.exception("Failed to update the voice index", exc_info=True)
+
+
+def _get_voices_dir_mtime():
+    try:
+        return os.stat(TECHIAITH_VOICES_DIR).st_mtime_ns
+    except FileNotFoundError:
+        Path(TECHIAITH_VOICES_DIR).mkdir(parents=True, exist_ok=True)
+        return os.stat(TECHIAITH_VOICES_DIR).st_mtime_ns
+
+
+def _get_index_file_mtime():
+    try:
+        return os.stat(VOICE_INDEX_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _read_index_file():
+    try:
+        with open(VOICE_INDEX_FILE, "r", encoding="utf-8") as file:
+            index = json.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        log.debug("Failed to read the voice index", exc_info=True)
+        return None
+    if (
+        not isinstance(index, dict)
+        or (index.get("version") != VOICE_INDEX_FORMAT_VERSION)
+        or (index.get("voices_dir") != TECHIAITH_VOICES_DIR)
+    ):
+        return None
+    return index
+
+
+def _build_index(voices_dir_mtime):
+    """Scan the voices directory. `voices_dir_mtime` is taken before the scan,
+    so that changes made while scanning invalidate the index.
+    """
+    voices = {}
+    for directory in (d for d in Path(TECHIAITH_VOICES_DIR).iterdir() if d.is_dir()):
+        try:
+            voices[directory.name] = read_voice_config(directory)
+        except (OSError, ValueError):
+            log.exception(
+                f"Failed to read the config of voice `{directory.name}`", exc_info=True
+            )
+            voices[directory.name] = None
+    index = {
+        "version": VOICE_INDEX_FORMAT_VERSION,
+        "voices_dir": TECHIAITH_VOICES_DIR,
+        "voices_dir_mtime_ns": voices_dir_mtime,
+        "voices": voices,
+    }
+    _write_index_file(index)
+    return index
+
+
+def _write_index_file(index):
+    # Write to a temporary file first, so readers never see a partial index
+    tmp_filename = Path(VOICE_INDEX_FILE).with_suffix(".tmp")
+    try:
+        with open(tmp_filename, "w", encoding="utf-8") as file:
+            json.dump(index, file, ensure_ascii=False)
+        os.replace(tmp_filename, VOICE_INDEX_FILE)
+    except OSError:
+        log.debug("Failed to write the voice index", exc_info=True)
+        with contextlib.suppress(OSError):
+            tmp_filename.unlink()
@@ -0,0 +1,148 @@
+# coding: utf-8
+
+# Copyright (c) 2023 Musharraf Omer
+# This file is covered by the GNU General Public License.
+
+"""Decides which voices stay loaded on the sonata server.
+
+Voices are loaded on first use and tracked in least recently used order.
+When loading another voice would exceed `max_loaded_voices` or the
+`loaded_voices_memory_budget` (in MiB), the least recently used voices
+that are not pinned are evicted. Both limits are off by default.
+
+The server cannot unload a single voice, so evicting restarts the server,
+through the server supervisor, which then loads the voices that are kept.
+Eviction waits until no speech is being synthesized, so that it does
+not cut off speech in progress.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from logHandler import log
+
+from . import grpc_client
+from ._config import TechiaithConfig
+from .const import VOICE_MEMORY_FACTOR
+
+
+def estimate_voice_memory(voice):
+    """Estimate the server memory used by `voice` in bytes, from the size
+    of its model file. Requires the voice's config to have been read.
+    """
+    model_path = voice.config_path.with_suffix("")
+    if not model_path.is_file():
+        model_path = next(voice.config_path.parent.glob("*.onnx"), None)
+    try:
+        return int(os.path.getsize(model_path) * VOICE_MEMORY_FACTOR)
+    except (OSError, TypeError):
+        return 0
+
+
+class VoiceResidency:
+    """Tracks the voices loaded on the server in least recently used order."""
+
+    def __init__(self):
+        # Voice key -> `(voice, estimated_memory)`, least recently used first
+        self._voices = OrderedDict()
+        self._pinned = set()
+        self._lock = asyncio.Lock()
+        self._active_streams = 0
+        # Set while no speech is being synthesized
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def pin(self, voice):
+        """Never evict `voice`."""
+        self._pinned.add(voice.key)
+
+    def unpin(self, voice):
+        self._pinned.discard(voice.key)
+
+    def touch(self, voice):
+        """Mark `voice` as the most recently used."""
+        if voice.key in self._voices:
+            self._voices.move_to_end(voice.key)
+
+    def discard(self, voice):
+        """Forget `voice`, because it is no longer loaded on the server."""
+        self._voices.pop(voice.key, None)
+
+    @contextmanager
+    def synthesizing(self):
+        """Mark speech as being synthesized for the duration of the block.
+        Must be used from the event loop.
+        """
+        self._active_streams += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._active_streams -= 1
+            if not self._active_streams:
+                self._idle.set()
+
+    async def reserve(self, voice):
+        """Make room for `voice` before it is loaded, evicting other voices
+        if needed. Must be called from the event loop.
+        """
+        async with self._lock:
+            memory = estimate_voice_memory(voice)
+            if grpc_client.GRPC_SERVER_PROCESS is not None:
+                evicted = self._select_evictions(voice, memory)
+            else:
+                # Only a server started by us can be restarted
+                evicted = []
+            self._voices[voice.key] = (voice, memory)
+            if not evicted:
+                return
+            log.info(
+                f"Evicting voices {[v.key for v in evicted]} to load voice {voice.key}, "
+                "once speech is idle"
+            )
+            await self._idle.wait()
+            for evicted_voice in evicted:
+                evicted_voice.reset_remote_state()
+        # The lock is released first, as the supervisor reloads the kept voices
+        await grpc_client.request_restart(f"to load voice {voice.key}")
+
+    def has_room_for(self, voice):
+        """Whether `voice` can be loaded without evicting another voice."""
+        if voice.key in self._voices:
+            return True
+        resident = OrderedDict(self._voices)
+        return not self._is_over_limit(resident, estimate_voice_memory(voice))
+
+    def _select_evictions(self, incoming_voice, incoming_memory):
+        resident = OrderedDict(
+            (key, entry) for (key, entry) in self._voices.items()
+            if key != incoming_voice.key
+        )
+        evicted = []
+        for key in list(resident):
+            if not self._is_over_limit(resident, incoming_memory):
+                break
+            if key in self._pinned:
+                continue
+            (voice, __) = resident.pop(key)
+            del self._voices[key]
+            evicted.append(voice)
+        if self._is_over_limit(resident, incoming_memory):
+            log.warning(
+                f"Loading voice {incoming_voice.key} exceeds the loaded voices limits, "
+                "as the remaining voices are pinned"
+            )
+        return evicted
+
+    @staticmethod
+    def _is_over_limit(resident, incoming_memory):
+        max_voices = TechiaithConfig.get("max_loaded_voices", 0)
+        memory_budget = TechiaithConfig.get("loaded_voices_memory_budget", 0) * 1024 * 1024
+        if max_voices and (len(resident) + 1 > max_voices):
+            return True
+        used_memory = sum(memory for (__, memory) in resident.values())
+        return bool(memory_budget) and (used_memory + incoming_memory > memory_budget)
+
+VOICE_RESIDENCY = VoiceResidency()
@@ -0,0 +1,125 @@
+# coding: utf-8
+
+"""A stand-in for `sonata-grpc.exe` that synthesizes silence.
+
+Audio is produced at a configurable real-time factor, so the timing
+behaviour of the driver can be measured without the real server or
+voice models.
+"""
+
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from concurrent import futures
+
+import grpc
+
+from techiaith_tts.grpc_client.grpc_protos import sonata_grpc_pb2 as msgs
+from techiaith_tts.grpc_client.grpc_protos.sonata_grpc_pb2_grpc import (
+    sonata_grpcServicer,
+    add_sonata_grpcServicer_to_server,
+)
+
+
+SAMPLE_RATE = 22050
+BYTES_PER_SECOND = SAMPLE_RATE * 2
+# Roughly the speaking rate of the Welsh voices at the default rate
+AUDIO_SECONDS_PER_CHAR = 0.065
+# Default audio duration of each streamed message
+CHUNK_SECONDS = 0.25
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+class FakeSonataServicer(sonata_grpcServicer):
+    def __init__(
+        self, rtf=0.3, first_chunk_latency=0.03, load_latency=0.0, chunk_seconds=CHUNK_SECONDS, fast_rtf=None
+    ):
+        self.rtf = rtf
+        # Real-time factor of the fast (+RT) variants, `rtf` if None
+        self.fast_rtf = fast_rtf
+        self.chunk_seconds = chunk_seconds
+        self.first_chunk_latency = first_chunk_latency
+        self.load_latency = load_latency
+        self._lock = threading.Lock()
+        self._voices = {}
+        self.requests = 0
+        self.requests_by_voice = Counter()
+        self.cancelled_requests = 0
+        self.options_requests = 0
+
+    def GetSonataVersion(self, request, context):
+        return msgs.Version(version="fake-sonata-bench")
+
+    def LoadVoice(self, request, context):
+        time.sleep(self.load_latency)
+        voice_id = os.path.basename(os.path.dirname(request.config_path))
+        with self._lock:
+            options = self._voices.setdefault(
+                voice_id,
+                msgs.SynthesisOptions(speaker="a", length_scale=1.0, noise_scale=0.667, noise_w=0.8),
+            )
+        return self._voice_info(voice_id, options)
+
+    def GetVoiceInfo(self, request, context):
+        return self._voice_info(request.voice_id, self._voices[request.voice_id])
+
+    def GetSynthesisOptions(self, request, context):
+        with self._lock:
+            self.options_requests += 1
+            return self._voices[request.voice_id]
+
+    def SetSynthesisOptions(self, request, context):
+        with self._lock:
+            self.options_requests += 1
+            options = self._voices[request.voice_id]
+            options.MergeFrom(request.synthesis_options)
+            return options
+
+    def SynthesizeUtterance(self, request, context):
+        with self._lock:
+            self.requests += 1
+            self.requests_by_voice[request.voice_id] += 1
+        rtf = self.rtf
+        if (self.fast_rtf is not None) and ("+RT" in request.voice_id):
+            rtf = self.fast_rtf
+        sentences = [s for s in SENTENCE_PATTERN.split(request.text) if s.strip()]
+        time.sleep(self.first_chunk_latency)
+        for sentence in sentences:
+            audio_seconds = len(sentence) * AUDIO_SECONDS_PER_CHAR
+            num_chunks = max(math.ceil(audio_seconds / self.chunk_seconds), 1)
+            chunk_seconds = audio_seconds / num_chunks
+            for __ in range(num_chunks):
+                time.sleep(chunk_seconds * rtf)
+                if not context.is_active():
+                    with self._lock:
+                        self.cancelled_requests += 1
+                    return
+                num_bytes = int(chunk_seconds * BYTES_PER_SECOND) & ~1
+                yield msgs.SynthesisResult(wav_samples=bytes(num_bytes), rtf=rtf)
+
+    def SynthesizeUtteranceRealtime(self, request, context):
+        for result in self.SynthesizeUtterance(request, context):
+            yield msgs.WaveSamples(wav_samples=result.wav_samples)
+
+    def _voice_info(self, voice_id, options):
+        return msgs.VoiceInfo(
+            voice_id=voice_id,
+            synth_options=options,
+            speakers={0: "a", 1: "b"},
+            audio=msgs.AudioInfo(sample_rate=SAMPLE_RATE, num_channels=1, sample_width=2),
+            language="cy",
+            quality=msgs.QUALITY_MEDIUM,
+            supports_streaming_output=False,
+        )
+
+
+def start_server(servicer, max_workers=None, address="localhost:0"):
+    """Start a gRPC server for `servicer`, returning `(server, port)`."""
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers or (os.cpu_count() or 1) * 4))
+    add_sonata_grpcServicer_to_server(servicer, server)
+    port = server.add_insecure_port(address)
+    server.start()
+    return server, port
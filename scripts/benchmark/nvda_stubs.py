@@ -0,0 +1,270 @@
+# coding: utf-8
+
+"""Minimal stand-ins for the NVDA modules imported by the synth driver.
+
+`install()` registers them in `sys.modules` so that the driver can be
+imported and exercised on any platform without NVDA.
+"""
+
+import builtins
+import ctypes
+import logging
+import sys
+import tempfile
+import threading
+import time
+import types
+
+
+log = logging.getLogger("nvda")
+
+
+class Action:
+    """Mimics `extensionPoints.Action`."""
+
+    def __init__(self):
+        self._handlers = []
+
+    def register(self, handler):
+        self._handlers.append(handler)
+
+    def unregister(self, handler):
+        self._handlers.remove(handler)
+
+    def notify(self, **kwargs):
+        for handler in list(self._handlers):
+            handler(**kwargs)
+
+
+class ConfigSection(dict):
+    """A dict that behaves enough like an NVDA `AggregatedSection`."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.spec = {}
+        for (key, value) in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def isSet(self, key):
+        return key in self
+
+    def __setitem__(self, key, value):
+        if isinstance(value, dict) and not isinstance(value, ConfigSection):
+            value = ConfigSection(value)
+        super().__setitem__(key, value)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+class DriverSetting:
+    def __init__(self, id, displayNameWithAccelerator, availableInSettingsRing=False, displayName=None, **kwargs):
+        self.id = id
+        self.displayNameWithAccelerator = displayNameWithAccelerator
+        self.displayName = displayName or displayNameWithAccelerator
+        self.availableInSettingsRing = availableInSettingsRing
+
+
+class NumericDriverSetting(DriverSetting):
+    pass
+
+
+class BooleanDriverSetting(DriverSetting):
+    pass
+
+
+class VoiceInfo:
+    def __init__(self, id, displayName, language=None):
+        self.id = id
+        self.displayName = displayName
+        self.language = language
+
+
+class SynthDriver:
+    """Emulates the auto property behaviour of NVDA's `SynthDriver`."""
+
+    @classmethod
+    def VoiceSetting(cls):
+        return DriverSetting("voice", "&Voice")
+
+    @classmethod
+    def VariantSetting(cls):
+        return DriverSetting("variant", "V&ariant")
+
+    @classmethod
+    def RateSetting(cls):
+        return NumericDriverSetting("rate", "&Rate")
+
+    @classmethod
+    def RateBoostSetting(cls):
+        return BooleanDriverSetting("rateBoost", "Rate boos&t")
+
+    @classmethod
+    def VolumeSetting(cls):
+        return NumericDriverSetting("volume", "V&olume")
+
+    @classmethod
+    def PitchSetting(cls):
+        return NumericDriverSetting("pitch", "&Pitch")
+
+    def __getattr__(self, name):
+        getter = getattr(type(self), f"_get_{name}", None)
+        if getter is None:
+            raise AttributeError(name)
+        return getter(self)
+
+    def __setattr__(self, name, value):
+        setter = getattr(type(self), f"_set_{name}", None)
+        if setter is not None:
+            setter(self, value)
+        else:
+            object.__setattr__(self, name, value)
+
+    def _get_availableVariants(self):
+        return self._getAvailableVariants()
+
+    @staticmethod
+    def _percentToParam(percent, min, max):
+        return float(percent) / 100 * (max - min) + min
+
+
+class SimulatedWavePlayer:
+    """Plays audio against a simulated clock.
+
+    Fed audio is queued behind whatever is still "playing". `sync` and
+    `idle` sleep until the queued audio has played. The player records
+    when audio first arrives and any gaps (underruns) in playback.
+    """
+
+    # The real player accepts this much audio before `feed` blocks
+    MAX_BUFFERED_SECONDS = 2.0
+
+    def __init__(self, channels=1, samplesPerSec=22050, bitsPerSample=16, outputDevice=None, **kwargs):
+        self.bytes_per_second = samplesPerSec * channels * bitsPerSample // 8
+        self._lock = threading.Lock()
+        self._play_end = 0.0
+        self.played_seconds = 0.0
+        self.first_feed_times = []
+        self.underruns = []
+        self._track_underruns = False
+
+    def track_underruns(self, enable):
+        with self._lock:
+            self._track_underruns = enable
+            self._play_end = 0.0
+
+    def feed(self, data, size=None, onDone=None):
+        if size is None:
+            size = len(data)
+        else:
+            # Like the real player, copy the audio out of the pointer
+            ctypes.string_at(data, size)
+        duration = size / self.bytes_per_second
+        now = time.perf_counter()
+        with self._lock:
+            if self._play_end <= now:
+                if self._track_underruns and self._play_end:
+                    self.underruns.append(now - self._play_end)
+                self.first_feed_times.append(now)
+                self._play_end = now
+            self._play_end += duration
+            self.played_seconds += duration
+            ahead = self._play_end - now - self.MAX_BUFFERED_SECONDS
+        if ahead > 0:
+            time.sleep(ahead)
+        if onDone is not None:
+            threading.Timer(max(self._play_end - time.perf_counter(), 0), onDone).start()
+
+    def sync(self):
+        remaining = self._play_end - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    idle = sync
+
+    def stop(self):
+        with self._lock:
+            self._play_end = 0.0
+
+    def pause(self, switch):
+        pass
+
+    def setVolume(self, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+class _SayAllHandler:
+    running = False
+
+    @classmethod
+    def isRunning(cls):
+        return cls.running
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def _command(name, *fields):
+    def __init__(self, *args):
+        for (field, value) in zip(fields, args):
+            setattr(self, field, value)
+
+    return type(name, (), {"__init__": __init__})
+
+
+def install(config_path=None):
+    """Register the stub modules. Returns the NVDA configuration dict."""
+    builtins._ = lambda s: s
+    config_path = config_path or tempfile.mkdtemp(prefix="techiaith_bench_")
+    conf = ConfigSection(
+        {
+            "audio": {"outputDevice": None},
+            "debugLog": {"synthDriver": False},
+            "speech": {},
+        }
+    )
+    _module("globalVars", appArgs=types.SimpleNamespace(configPath=config_path), appDir=config_path)
+    _module("config", conf=conf)
+    _module("logHandler", log=log)
+    _module("languageHandler", normalizeLanguage=lambda lang: lang.replace("_", "-"))
+    _module("addonHandler", initTranslation=lambda: None)
+    _module("nvwave", WavePlayer=SimulatedWavePlayer)
+    _module("wx", GetTopLevelWindows=lambda: [])
+    _module("gui")
+    _module("gui.settingsDialogs", NVDASettingsDialog=type("NVDASettingsDialog", (), {}), SpeechSettingsPanel=type("SpeechSettingsPanel", (), {}))
+    _module("autoSettingsUtils")
+    _module(
+        "autoSettingsUtils.driverSetting",
+        DriverSetting=DriverSetting,
+        NumericDriverSetting=NumericDriverSetting,
+        BooleanDriverSetting=BooleanDriverSetting,
+    )
+    _module(
+        "synthDriverHandler",
+        SynthDriver=SynthDriver,
+        VoiceInfo=VoiceInfo,
+        synthIndexReached=Action(),
+        synthDoneSpeaking=Action(),
+    )
+    speech = _module("speech", sayAll=types.SimpleNamespace(SayAllHandler=_SayAllHandler))
+    speech.commands = _module(
+        "speech.commands",
+        BreakCommand=_command("BreakCommand", "time"),
+        IndexCommand=_command("IndexCommand", "index"),
+        LangChangeCommand=_command("LangChangeCommand", "lang"),
+        RateCommand=_command("RateCommand", "newValue"),
+        VolumeCommand=_command("VolumeCommand", "newValue"),
+        PitchCommand=_command("PitchCommand", "newValue"),
+    )
+    return conf
+
+
+def set_say_all_running(running):
+    _SayAllHandler.running = running
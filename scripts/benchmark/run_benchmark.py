@@ -0,0 +1,331 @@
+# coding: utf-8
+
+"""Benchmark the Techiaith TTS synth driver without NVDA.
+
+Runs the real driver against a fake sonata gRPC server and a simulated
+audio player, and reports latency percentiles and throughput for typical
+screen reader workloads.
+
+Usage:
+    python scripts/benchmark/run_benchmark.py [--rtf 0.3] [--scenario say_all]
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import socket
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# Import grpc and protobuf from site-packages before the driver puts its
+# bundled (Windows only) copies on sys.path
+import grpc
+import google.protobuf
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+SYNTH_DRIVERS_DIR = BENCHMARK_DIR.parent.parent.joinpath("addon", "synthDrivers")
+sys.path.insert(0, os.fspath(SYNTH_DRIVERS_DIR))
+sys.path.insert(0, os.fspath(BENCHMARK_DIR))
+
+import nvda_stubs
+
+
+FOCUS_PHRASES = (
+    "botwm",
+    "dolen",
+    "pennawd lefel 2",
+    "Ffeil",
+    "Golygu",
+    "blwch ticio heb ei dicio",
+    "Cadw",
+    "Canslo",
+)
+ARROW_KEY_LINES = (
+    "Mae'r tywydd yn braf heddiw yng Nghaerdydd.",
+    "Cafodd y cyfarfod ei ohirio tan yr wythnos nesaf.",
+    "Dyma'r drydedd linell yn y ddogfen hir hon.",
+    "Roedd y plant yn chwarae yn y parc ar ôl ysgol.",
+    "Bydd y trên nesaf i Fangor yn gadael am hanner dydd.",
+)
+# Say all speaks a document one line at a time
+SAY_ALL_LINES = (
+    "Mae'r Gymraeg yn un o ieithoedd hynaf Ewrop, ac fe'i siaredir gan dros hanner miliwn o bobl.",
+    "Mae technoleg iaith yn helpu siaradwyr i ddefnyddio'r iaith bob dydd.",
+    "Gall darllenwyr sgrin ddarllen dogfennau hir yn uchel i ddefnyddwyr dall. Mae hyn yn bwysig.",
+    "Byr.",
+)
+# Lines queued ahead of the line being spoken during say-all
+SAY_ALL_BUFFERED_LINES = 3
+
+# Server real-time factors of the standard and fast variants in the adaptive
+# variant scenario, where the standard variant cannot keep up
+SLOW_MACHINE_RTF = 1.3
+SLOW_MACHINE_FAST_RTF = 0.4
+
+
+# The parts of a piper voice config read by the driver
+FAKE_VOICE_CONFIG = {
+    "audio": {"sample_rate": 22050, "quality": "medium"},
+    "inference": {"noise_scale": 0.667, "length_scale": 1.0, "noise_w": 0.8},
+    "num_speakers": 2,
+    "speaker_id_map": {"a": 0, "b": 1},
+}
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def create_fake_voices(config_path):
+    voices_dir = Path(config_path, "techiaith_tts", "voices", "piper")
+    for key in ("cy-bench-medium", "cy-bench+RT-medium"):
+        voice_dir = voices_dir.joinpath(key)
+        voice_dir.mkdir(parents=True, exist_ok=True)
+        voice_dir.joinpath("voice.onnx.json").write_text(json.dumps(FAKE_VOICE_CONFIG))
+
+
+class SpeechWaiter:
+    """Waits for index and done speaking notifications from the driver."""
+
+    def __init__(self, synthDriverHandler):
+        self._condition = threading.Condition()
+        self._indexes = set()
+        self._done = 0
+        synthDriverHandler.synthIndexReached.register(self._on_index)
+        synthDriverHandler.synthDoneSpeaking.register(self._on_done)
+
+    def _on_index(self, synth, index):
+        with self._condition:
+            self._indexes.add(index)
+            self._condition.notify_all()
+
+    def _on_done(self, synth):
+        with self._condition:
+            self._done += 1
+            self._condition.notify_all()
+
+    def done_count(self):
+        with self._condition:
+            return self._done
+
+    def wait_for_done(self, previous_count, timeout=30):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._done > previous_count, timeout)
+
+    def clear_indexes(self):
+        with self._condition:
+            self._indexes.clear()
+
+    def wait_for_index(self, index, timeout=30):
+        with self._condition:
+            return self._condition.wait_for(lambda: index in self._indexes, timeout)
+
+
+def speak_and_wait(driver, waiter, sequence, speak_times):
+    done_count = waiter.done_count()
+    start = time.perf_counter()
+    driver.speak(sequence)
+    speak_times.add((time.perf_counter() - start) * 1000)
+    waiter.wait_for_done(done_count)
+
+
+def wait_until_played(driver):
+    from techiaith_tts import aio
+
+    feeder = driver._feeder
+    fed = threading.Event()
+    # Registered from the event loop, so that it covers all the audio queued so far
+    aio.ASYNCIO_EVENT_LOOP.call_soon_threadsafe(feeder.add_fed_callback, fed.set)
+    fed.wait()
+    feeder.player.sync()
+
+
+def scenario_focus_changes(driver, waiter, iterations, **kwargs):
+    speak_times = kwargs["new_stats"]()
+    for phrase in itertools.islice(itertools.cycle(FOCUS_PHRASES), iterations):
+        speak_and_wait(driver, waiter, [phrase], speak_times)
+    return {"speak_call_ms": speak_times.summary()}
+
+
+def scenario_arrow_key_spam(driver, waiter, iterations, interval=0.03, **kwargs):
+    speak_times = kwargs["new_stats"]()
+    for line in itertools.islice(itertools.cycle(ARROW_KEY_LINES), iterations):
+        start = time.perf_counter()
+        driver.cancel()
+        driver.speak([line])
+        speak_times.add((time.perf_counter() - start) * 1000)
+        time.sleep(interval)
+    done_count = waiter.done_count()
+    waiter.wait_for_done(done_count - 1)
+    time.sleep(0.5)
+    return {"cancel_and_speak_call_ms": speak_times.summary()}
+
+
+def scenario_say_all(driver, waiter, iterations, **kwargs):
+    IndexCommand = sys.modules["speech.commands"].IndexCommand
+    player = driver._feeder.player
+    player.track_underruns(True)
+    nvda_stubs.set_say_all_running(True)
+    waiter.clear_indexes()
+    start = time.perf_counter()
+    played_before = player.played_seconds
+    underruns_before = len(player.underruns)
+    try:
+        lines = itertools.cycle(SAY_ALL_LINES)
+        # Like NVDA's speech manager, indexes start at 1. Like NVDA's say-all,
+        # keep a few lines queued ahead of the line being spoken
+        for index in range(1, iterations + 1):
+            driver.speak([next(lines), IndexCommand(index)])
+            if index > SAY_ALL_BUFFERED_LINES:
+                waiter.wait_for_index(index - SAY_ALL_BUFFERED_LINES)
+        wait_until_played(driver)
+    finally:
+        nvda_stubs.set_say_all_running(False)
+        player.track_underruns(False)
+    elapsed = time.perf_counter() - start
+    audio_seconds = player.played_seconds - played_before
+    underruns = player.underruns[underruns_before:]
+    return {
+        "audio_seconds": round(audio_seconds, 2),
+        "wall_seconds": round(elapsed, 2),
+        "playback_efficiency": round(audio_seconds / elapsed, 3),
+        "underruns": len(underruns),
+        "underrun_total_ms": round(sum(underruns) * 1000, 1),
+    }
+
+
+def scenario_adaptive_variant(driver, waiter, iterations, **kwargs):
+    """Say all in the adaptive variant, on a machine too slow for the standard variant."""
+    servicer = kwargs["servicer"]
+    saved_rtf = (servicer.rtf, servicer.fast_rtf)
+    (servicer.rtf, servicer.fast_rtf) = (SLOW_MACHINE_RTF, SLOW_MACHINE_FAST_RTF)
+    requests_before = servicer.requests_by_voice.copy()
+    driver.variant = "adaptive"
+    try:
+        result = scenario_say_all(driver, waiter, iterations, **kwargs)
+    finally:
+        driver.variant = "standard"
+        (servicer.rtf, servicer.fast_rtf) = saved_rtf
+    requests = servicer.requests_by_voice - requests_before
+    result["fast_variant_requests"] = sum(n for (voice_id, n) in requests.items() if "+RT" in voice_id)
+    result["standard_variant_requests"] = sum(requests.values()) - result["fast_variant_requests"]
+    return result
+
+def scenario_voice_switching(driver, waiter, iterations, **kwargs):
+    switch_times = kwargs["new_stats"]()
+    speak_times = kwargs["new_stats"]()
+    settings = itertools.cycle((("variant", "fast"), ("speaker", "b"), ("variant", "standard"), ("speaker", "a")))
+    for (name, value) in itertools.islice(settings, iterations):
+        start = time.perf_counter()
+        setattr(driver, name, value)
+        switch_times.add((time.perf_counter() - start) * 1000)
+        speak_and_wait(driver, waiter, [FOCUS_PHRASES[0] + " " + value], speak_times)
+    return {"setting_change_ms": switch_times.summary(), "speak_call_ms": speak_times.summary()}
+
+
+SCENARIOS = {
+    "focus_changes": scenario_focus_changes,
+    "arrow_key_spam": scenario_arrow_key_spam,
+    "say_all": scenario_say_all,
+    "voice_switching": scenario_voice_switching,
+    "adaptive_variant": scenario_adaptive_variant,
+}
+REPORTED_METRICS = ("time_to_first_byte", "time_to_first_audio", "cancellation_latency", "underrun", "queue_depth")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rtf", type=float, default=0.3, help="Real-time factor of the fake server")
+    parser.add_argument("--first-chunk-latency", type=float, default=0.03, help="Seconds before the fake server starts a request")
+    parser.add_argument("--chunk-seconds", type=float, default=0.25, help="Audio duration of each message from the fake server")
+    parser.add_argument("--transport", choices=("tcp", "unix"), default="tcp", help="Channel transport to the server")
+    parser.add_argument("--channel-profile", choices=("low_latency", "default"), default="low_latency", help="gRPC channel options")
+    parser.add_argument("--iterations", type=int, default=20, help="Utterances per scenario")
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append", help="Run only this scenario (repeatable)")
+    parser.add_argument("--json", dest="json_output", help="Also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the driver's log")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    config_path = tempfile.mkdtemp(prefix="techiaith_bench_")
+    conf = nvda_stubs.install(config_path)
+    conf["speech"]["techiaith_tts"] = {"channel_profile": args.channel_profile}
+    create_fake_voices(config_path)
+
+    # The driver connects as soon as it is imported, so point it at the
+    # fake server before importing anything from `techiaith_tts`
+    port = find_free_port()
+    globalVars = sys.modules["globalVars"]
+    globalVars.SONATA_GRPC_SERVER_PORT = port
+    globalVars.GRPC_SERVER_PROCESS = None
+    globalVars.SONATA_GRPC_TRANSPORT = args.transport
+
+    startup_start = time.perf_counter()
+    import techiaith_tts
+    from fake_sonata_server import FakeSonataServicer, start_server
+    from techiaith_tts.instrumentation import METRICS, RollingStats
+
+    servicer = FakeSonataServicer(
+        rtf=args.rtf, first_chunk_latency=args.first_chunk_latency, chunk_seconds=args.chunk_seconds
+    )
+    techiaith_tts._GRPC_IS_INIT.result()
+    server, __ = start_server(servicer, address=techiaith_tts.grpc_client.get_server_address())
+    driver = techiaith_tts.SynthDriver()
+    startup_ms = (time.perf_counter() - startup_start) * 1000
+    waiter = SpeechWaiter(sys.modules["synthDriverHandler"])
+
+    results = {
+        "server_rtf": args.rtf,
+        "transport": args.transport,
+        "channel_profile": args.channel_profile,
+        "driver_startup_ms": round(startup_ms, 1),
+        "scenarios": {},
+    }
+    for name in args.scenario or SCENARIOS:
+        METRICS.reset()
+        requests_before = servicer.requests
+        cancelled_before = servicer.cancelled_requests
+        scenario_result = SCENARIOS[name](
+            driver, waiter, args.iterations, new_stats=RollingStats, servicer=servicer
+        )
+        summary = METRICS.summary()
+        for metric in REPORTED_METRICS:
+            if summary[metric]["count"]:
+                scenario_result[metric + "_ms" if metric != "queue_depth" else metric] = summary[metric]
+        scenario_result["bytes_synthesized"] = summary["bytes_synthesized"]
+        scenario_result["server_requests"] = servicer.requests - requests_before
+        scenario_result["server_requests_cancelled"] = servicer.cancelled_requests - cancelled_before
+        results["scenarios"][name] = scenario_result
+        print_scenario(name, scenario_result)
+
+    driver.terminate()
+    server.stop(grace=None)
+    if args.json_output:
+        with open(args.json_output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    print(
+        f"\nDriver startup: {startup_ms:.1f} ms "
+        f"(server rtf {args.rtf}, {args.transport} transport, {args.channel_profile} channel profile)"
+    )
+
+
+def print_scenario(name, result):
+    print(f"\n== {name} ==")
+    for (key, value) in result.items():
+        if isinstance(value, dict):
+            value = "  ".join(f"{k}={v}" for (k, v) in value.items())
+        print(f"  {key:<32} {value}")
+
+
+if __name__ == "__main__":
+    main()